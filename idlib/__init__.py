@@ -23,6 +23,8 @@ from idlib.systems import (Ark,
                            Uri,
                            Urn,)
 
+from idlib.batch import resolve_many
+
 # assign default identifier classes to streams
 StreamUri._id_class = Uri
 
@@ -2,6 +2,27 @@
  'auth-variables':
  {'cache-path': {'default': '{:user-cache-path}/idlib',
                  'environment-variables': 'IDLIB_CACHE_PATH CACHE_PATH'},
+  'cache-backend': {'default': 'file',
+                    'environment-variables': 'IDLIB_CACHE_BACKEND'},
+  'cache-layout': {'default': 'flat',
+                   'environment-variables': 'IDLIB_CACHE_LAYOUT'},
+  'cache-compress': {'default': None,
+                     'environment-variables': 'IDLIB_CACHE_COMPRESS'},
+  'cache-max-bytes': {'default': None,
+                      'environment-variables': 'IDLIB_CACHE_MAX_BYTES'},
+  'cache-max-bytes-total': {'default': None,
+                            'environment-variables': 'IDLIB_CACHE_MAX_BYTES_TOTAL'},
+  'cache-eviction': {'default': 'lru',
+                     'environment-variables': 'IDLIB_CACHE_EVICTION'},
+  'cache-chain-ttl': {'default': 604800,
+                      'environment-variables': 'IDLIB_CACHE_CHAIN_TTL'},
+  'cache-dereference-max-entries': {'default': 10000,
+                                    'environment-variables':
+                                    'IDLIB_CACHE_DEREFERENCE_MAX_ENTRIES'},
+  'cache-dereference-weak': {'default': False,
+                             'environment-variables': 'IDLIB_CACHE_DEREFERENCE_WEAK'},
+  'cache-data-ttl': {'default': 604800,
+                     'environment-variables': 'IDLIB_CACHE_DATA_TTL'},
   'log-path': {'default': '{:user-log-path}/idlib',
                'environment-variables': 'IDLIB_LOG_PATH LOG_PATH'},
   'protocols-io-api-client-token': None,
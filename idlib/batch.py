@@ -0,0 +1,145 @@
+""" resolve many identifiers at once
+
+    everything here is network bound so a thread pool is enough,
+    jobs are dispatched round robin across systems so that a slow
+    system cannot starve the others and no system has more than
+    its limit of requests in flight at any one time """
+
+from collections import namedtuple, deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from idlib.utils import log, deadline
+
+Result = namedtuple('Result', ['index', 'stream', 'values', 'error'])
+
+MAX_WORKERS = 32
+PER_SYSTEM = 8  # default limit on concurrent requests to any one system
+
+
+def _auto(something):
+    from idlib.from_oq import Auto
+    return Auto(something)
+
+
+def _system(stream):
+    return stream.__class__
+
+
+def _run(index, s, what, timeout):
+    values = {}
+    try:
+        with deadline(timeout):
+            for name in what:
+                value = getattr(s, name)
+                values[name] = value() if callable(value) else value
+    except Exception as e:
+        return Result(index, s, values, e)
+
+    return Result(index, s, values, None)
+
+
+def resolve_many(ids, what=('metadata',), max_workers=MAX_WORKERS, per_system=PER_SYSTEM,
+                 limits=None, ordered=True, stream=None, raise_on_error=False,
+                 timeout=None):
+    """ fetch `what` for every identifier in ids concurrently
+
+        ids may be streams e.g. idlib.Doi or strings which are converted
+        by stream, by default idlib.Auto, what names methods or properties
+        of the streams, e.g. ('metadata', 'dereference_chain')
+
+        yields Result(index, stream, values, error) where values maps
+        each name in what to its value, errors are returned in error
+        unless raise_on_error is set, in input order when ordered is
+        True otherwise as each identifier finishes
+
+        limits maps a stream class e.g. idlib.Doi to the maximum number
+        of identifiers from that system that are fetched at once, any
+        class not in limits gets per_system, connection reuse per host
+        is handled by the shared session see idlib.core.pooled_requests
+
+        timeout is the seconds allowed for each identifier, when it runs
+        out the result has a DeadlineExceededError see idlib.utils.deadline """
+
+    if isinstance(what, str):
+        what = what,
+
+    if stream is None:
+        stream = _auto
+
+    limits = {} if limits is None else limits
+
+    # convert up front to find the system, conversion does not touch
+    # the network and failures are reported in order with everything else
+    queues = OrderedDict()
+    count = 0
+    errors = {}
+    for index, something in enumerate(ids):
+        count += 1
+        if not hasattr(something, 'identifier'):
+            try:
+                something = stream(something)
+            except Exception as e:
+                errors[index] = Result(index, something, {}, e)
+                continue
+
+        system = _system(something)
+        if system not in queues:
+            queues[system] = deque()
+
+        queues[system].append((index, something))
+
+    def limit(system):
+        return limits.get(system, per_system)
+
+    def results():
+        inflight = {}
+        running = {system: 0 for system in queues}
+        done_results = dict(errors)
+        next_index = 0
+        with ThreadPoolExecutor(max_workers) as pool:
+            while True:
+                # round robin over the systems that are under their limit
+                progress = True
+                while progress and len(inflight) < max_workers:
+                    progress = False
+                    for system, queue in queues.items():
+                        if len(inflight) >= max_workers:
+                            break
+
+                        if queue and running[system] < limit(system):
+                            index, s = queue.popleft()
+                            fut = pool.submit(_run, index, s, what, timeout)
+                            inflight[fut] = system
+                            running[system] += 1
+                            progress = True
+
+                if ordered:
+                    while next_index in done_results:
+                        yield done_results.pop(next_index)
+                        next_index += 1
+                elif done_results:
+                    yield from done_results.values()
+                    done_results.clear()
+
+                if not inflight:
+                    break
+
+                finished, _ = wait(inflight, return_when=FIRST_COMPLETED)
+                for fut in finished:
+                    running[inflight.pop(fut)] -= 1
+                    result = fut.result()
+                    if result.error is not None:
+                        if raise_on_error:
+                            for f in inflight:
+                                f.cancel()
+
+                            raise result.error
+
+                        log.debug(f'{result.stream} failed with {result.error!r}')
+
+                    done_results[result.index] = result
+
+    if raise_on_error and errors:
+        raise errors[min(errors)].error
+
+    log.debug(f'resolving {count} identifiers across {len(queues)} systems')
+    return results()
@@ -1,12 +1,55 @@
+import os
+import gzip
+import asyncio
 import json
+import mmap
 import pickle
+import struct
+import shutil
+import sqlite3
 import hashlib
 import inspect
+import itertools
+import tempfile
+import contextvars
+import threading
+from time import time, time_ns, sleep, perf_counter
 from pathlib import Path
 from functools import wraps
-from .utils import log
+from itertools import islice
+from contextlib import contextmanager, asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple
+from .utils import log, LRUCache, current_deadline
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+    log.warning('no windows support for cross process cache locks right now')
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 COOLDOWN = '__idlib.cache_cooldown'
+COOLDOWN_TIME = '__idlib.cache_cooldown_time'
+LOCK_TIMEOUT = 300  # seconds to wait for another process to fill a key
+
+# mkstemp creates files 0600, match what open would have done
+_umask = os.umask(0)
+os.umask(_umask)
 
 _type_order = (
     bool, int, float, bytes, str, tuple, list, set, dict, object, type, None
@@ -27,12 +70,16 @@ def args_sort_key(kv):
     return k, type_index(v), v
 
 
-def cache_hash(pairs, cypher=hashlib.blake2s):
+def cache_hash(pairs, cypher=hashlib.blake2s, canonical=True):
+    """ canonical=False reproduces the keys used before identifiers
+        provided asCacheKey, see rekey """
     pairs = sorted(pairs, key=args_sort_key)
     converted = []
     for k, v in pairs:
         if k == 'self':  # FIXME convention only ...
             v, _v = v.__class__, v
+        elif canonical and hasattr(v, 'asCacheKey'):  # idlib.Identifier
+            v = v.asCacheKey()
         converted.append(k.encode() + b'\x01' + str(v).encode())
 
     message = b'\x02'.join(converted)
@@ -57,25 +104,1557 @@ def argspector(function):
     return spector
 
 
-def cache(folder, ser='json', clear_cache=False, create=False, return_path=False, debug=False):
+## serialization
+
+def _json_dumps(output):
+    return json.dumps(output).encode()
+
+
+def _json_loads(data):
+    return json.loads(data)
+
+
+def _orjson_loads(data):
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        # stdlib accepts a few things orjson does not e.g. NaN
+        return json.loads(data)
+
+
+def _msgpack_dumps(output):
+    return msgpack.packb(output, use_bin_type=True)
+
+
+def _msgpack_loads(data):
+    # namespaces that switched from json still have json entries
+    if data[:1] in (b'{', b'['):
+        return json.loads(data) if orjson is None else _orjson_loads(data)
+
+    return msgpack.unpackb(data, raw=False)
+
+
+# orjson and msgpack fall back to json when they are not installed
+# orjson output is plain json so entries are interchangeable with json
+_serializers = {
+    'json': (_json_dumps, _json_loads),
+    'pickle': (pickle.dumps, pickle.loads),
+    'orjson': ((_json_dumps, _json_loads) if orjson is None else
+               (orjson.dumps, _orjson_loads)),
+    'msgpack': ((_json_dumps, _json_loads) if msgpack is None else
+                (_msgpack_dumps, _msgpack_loads)),
+}
+
+
+## memory tier
+
+# process wide, checked by every cache decorator before touching
+# the store, outputs are kept serialized and decoded on every hit
+# so that callers own what they get back and can mutate it e.g.
+# Pio.asOrg, cooldowns are never kept in memory
+memory = _memory = LRUCache(max_entries=10000, max_bytes=256 * 1024 ** 2)
+_miss = object()
+
+
+def set_memory_limits(max_entries=None, max_bytes=None):
+    """ resize the memory tier, None means unbounded, use
+        max_entries=0 to disable the memory tier entirely """
+    memory.resize(max_entries, max_bytes)
+
+
+## instrumentation
+
+LATENCY_BUCKETS = tuple(0.0001 * 2 ** i for i in range(20))  # 100us to ~52s upper bounds
+
+
+class Histogram:
+    """ latency histogram with exponential buckets in seconds """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last is overflow
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, seconds):
+        for i, le in enumerate(self.buckets):
+            if seconds <= le:
+                break
+        else:
+            i = len(self.buckets)
+
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        """ upper bound of the bucket containing quantile q """
+        if not self.count:
+            return None
+
+        rank = q * self.count
+        seen = 0
+        for le, n in zip(self.buckets + (self.max,), self.counts):
+            seen += n
+            if seen >= rank:
+                return le
+
+    def snapshot(self):
+        return {'count': self.count,
+                'sum': self.sum,
+                'max': self.max,
+                'p50': self.quantile(0.5),
+                'p99': self.quantile(0.99),
+                'buckets': {le: n for le, n in
+                            zip(self.buckets + (float('inf'),), self.counts) if n},}
+
+
+class NamespaceStats:
+    """ counters and latencies for a single cache folder """
+
+    counters = ('memory_hits', 'hits', 'misses', 'cooldown_hits', 'not_modified',
+                'write_failures', 'bytes_read', 'bytes_written')
+    outcomes = 'memory', 'hit', 'miss', 'cooldown'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counts = {c: 0 for c in self.counters}
+            self.latency = {o: Histogram() for o in self.outcomes}
+
+    def incr(self, counter, n=1):
+        with self._lock:
+            self.counts[counter] += n
+
+    def observe(self, outcome, seconds):
+        with self._lock:
+            self.latency[outcome].observe(seconds)
+
+    def snapshot(self):
+        with self._lock:
+            return {**self.counts,
+                    'latency': {o: h.snapshot() for o, h in self.latency.items()
+                                if h.count},}
+
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def _namespace_stats(folder):
+    with _stats_lock:
+        if folder not in _stats:
+            _stats[folder] = NamespaceStats()
+
+        return _stats[folder]
+
+
+def cache_stats(folder=None):
+    """ snapshot of the counters and latency histograms for the cache
+        decorator on folder, or for every folder and the memory tier """
+    if folder is not None:
+        return _namespace_stats(Path(folder)).snapshot()
+
+    with _stats_lock:
+        items = list(_stats.items())
+
+    return {'memory': memory.stats(),
+            'namespaces': {str(f): ns.snapshot() for f, ns in items},}
+
+
+def reset_cache_stats():
+    with _stats_lock:
+        items = list(_stats.values())
+
+    for ns in items:
+        ns.reset()
+
+
+def dump_cache_stats(path=None):
+    """ write cache_stats() as json to path, or to the log if None """
+    blob = json.dumps(cache_stats(), indent=2, sort_keys=True)
+    if path is None:
+        log.info(f'cache stats\n{blob}')
+    else:
+        path = Path(path)
+        fd, temp = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.', suffix='.tmp')
+        with os.fdopen(fd, 'wt') as f:
+            f.write(blob)
+
+        os.replace(temp, path)
+
+
+def start_cache_stats_dump(interval=3600, path=None):
+    """ call dump_cache_stats every interval seconds in a daemon thread
+        returns an event that stops the dumps when set """
+    stop = threading.Event()
+    def run():
+        while not stop.wait(interval):
+            try:
+                dump_cache_stats(path)
+            except Exception as e:
+                log.exception(e)
+
+    threading.Thread(target=run, daemon=True).start()
+    return stop
+
+
+## cooldowns
+
+MINUTE = 60
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+
+# time to live in seconds for negative cache entries by status code
+# exact codes win over classes e.g. 500 covers any 5xx not listed
+# None means that the cooldown never expires
+COOLDOWN_TTLS = {
+    404: 30 * DAY,
+    410: None,
+    429: 10,
+    400: DAY,
+    500: 10 * MINUTE,
+}
+
+
+def cooldown_policy(ttls=COOLDOWN_TTLS, status_keys=('http_status_code',), default=DAY):
+    """ build a function that returns the time to live for a cooldown
+        blob from the first status key whose value has an entry in ttls
+
+        a `retry_after` value in the blob always takes precedence """
+
+    def policy(blob):
+        if 'retry_after' in blob:
+            return blob['retry_after']
+
+        for status_key in status_keys:
+            if status_key in blob:
+                status = blob[status_key]
+                if status in ttls:
+                    return ttls[status]
+
+                if isinstance(status, int) and status // 100 * 100 in ttls:
+                    return ttls[status // 100 * 100]
+
+        return default
+
+    return policy
+
+
+default_cooldown_policy = cooldown_policy()
+
+
+def cooldown_expired(blob, policy, stat=None):
+    """ check whether a cooldown blob has outlived its policy
+        entries written before cooldowns carried a timestamp
+        fall back to the modification time of the entry """
+    ttl = policy(blob)
+    if ttl is None:
+        return False
+
+    if COOLDOWN_TIME in blob:
+        then = blob[COOLDOWN_TIME]
+    elif stat is not None:
+        then = stat.st_mtime
+    else:
+        return True
+
+    return time() - then > ttl
+
+
+## http validators
+
+VALIDATORS = '__idlib.cache_validators'
+NOT_MODIFIED = type('NotModified', (), {'__repr__': lambda self: 'NOT_MODIFIED'})()
+_validated_headers = 'ETag', 'Last-Modified', 'Cache-Control'
+_validation = contextvars.ContextVar('_validation', default=None)
+
+
+def conditional_headers():
+    """ request headers for a function decorated with cache(validators=True)
+        that let the remote answer 304 if the cached entry is still current """
+    state = _validation.get()
+    if state is None or not state['previous']:
+        return {}
+
+    previous = state['previous']
+    headers = {}
+    if 'etag' in previous:
+        headers['If-None-Match'] = previous['etag']
+
+    if 'last-modified' in previous:
+        headers['If-Modified-Since'] = previous['last-modified']
+
+    return headers
+
+
+def record_validators(resp):
+    """ stash the validators from resp to be stored with the entry """
+    state = _validation.get()
+    if state is not None:
+        state['current'] = {h.lower(): resp.headers[h]
+                            for h in _validated_headers if h in resp.headers}
+
+
+## locking
+
+_held_locks = threading.local()
+
+
+def _try_acquire(lockpath):
+    """ returns a locked fd or None if someone else holds the lock """
+    while True:
+        fd = os.open(lockpath, os.O_CREAT | os.O_RDWR, 0o666 & ~_umask)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+
+        # holders unlink on release so make sure that we
+        # did not just lock an inode that is already gone
+        try:
+            if os.fstat(fd).st_ino == os.stat(lockpath).st_ino:
+                return fd
+        except FileNotFoundError:
+            pass
+
+        os.close(fd)
+
+
+def _lock_wait(wait, lockpath):
+    # a lock is never waited on past the deadline of the caller
+    d = current_deadline()
+    if d is None:
+        return wait
+
+    d.check(f'waiting for lock {lockpath}')
+    return max(min(wait, d.remaining()), 0)
+
+
+def _acquire(lockpath, timeout):
+    start = time()
+    wait = 0.01
+    while True:
+        fd = _try_acquire(lockpath)
+        if fd is not None:
+            return fd
+
+        if time() - start > timeout:
+            log.warning(f'gave up waiting for lock {lockpath}')
+            return None
+
+        sleep(_lock_wait(wait, lockpath))
+        wait = min(wait * 2, 0.5)
+
+
+async def _aacquire(lockpath, timeout):
+    start = time()
+    wait = 0.01
+    while True:
+        fd = _try_acquire(lockpath)
+        if fd is not None:
+            return fd
+
+        if time() - start > timeout:
+            log.warning(f'gave up waiting for lock {lockpath}')
+            return None
+
+        await asyncio.sleep(_lock_wait(wait, lockpath))
+        wait = min(wait * 2, 0.5)
+
+
+def _release(lockpath, fd):
+    try:
+        os.unlink(lockpath)
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def key_lock(folder, key, timeout=LOCK_TIMEOUT):
+    """ advisory lock on a single cache key that is shared by all
+        threads and processes using folder, reentrant per thread so
+        that functions like Rrid._metadata can retry by recursion """
+
+    if not hasattr(_held_locks, 'keys'):
+        _held_locks.keys = set()
+
+    held = _held_locks.keys
+    lkey = folder, key
+    # a coroutine holding the lock may hand work to a thread via in_thread
+    if lkey in held or lkey in _held_alocks.get() or fcntl is None:
+        yield
+        return
+
+    lockdir = folder / '.locks'
+    lockdir.mkdir(exist_ok=True)
+    lockpath = lockdir / key
+    fd = _acquire(lockpath, timeout)
+    held.add(lkey)
+    try:
+        yield
+    finally:
+        held.discard(lkey)
+        if fd is not None:
+            _release(lockpath, fd)
+
+
+_held_alocks = contextvars.ContextVar('_held_alocks', default=frozenset())
+
+
+@asynccontextmanager
+async def akey_lock(folder, key, timeout=LOCK_TIMEOUT):
+    """ key_lock for coroutines, waiting does not block the event loop,
+        reentrant per task and for any tasks that the holder starts """
+    held = _held_alocks.get()
+    lkey = folder, key
+    if lkey in held or fcntl is None:
+        yield
+        return
+
+    lockdir = folder / '.locks'
+    lockdir.mkdir(exist_ok=True)
+    lockpath = lockdir / key
+    fd = await _aacquire(lockpath, timeout)
+    token = _held_alocks.set(held | {lkey})
+    try:
+        yield
+    finally:
+        _held_alocks.reset(token)
+        if fd is not None:
+            _release(lockpath, fd)
+
+
+## compression
+
+_GZIP_MAGIC = b'\x1f\x8b'
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+ZSTD_LEVEL = 10
+ZSTD_DICTS = '.zstd-dicts'  # {folder}/.zstd-dicts/{dict_id} and /current
+
+# all dictionaries ever loaded by id, frames record the id of the
+# dictionary they were compressed with so old entries stay readable
+# after a namespace is retrained
+_zstd_dicts = {}
+
+
+def _load_zstd_dicts(folder):
+    """ load every dictionary trained for folder and return the current one """
+    ddir = folder / ZSTD_DICTS
+    if zstandard is None or not ddir.exists():
+        return
+
+    for path in ddir.iterdir():
+        if path.name.isdigit() and int(path.name) not in _zstd_dicts:
+            _zstd_dicts[int(path.name)] = zstandard.ZstdCompressionDict(path.read_bytes())
+
+    current = ddir / 'current'
+    if current.exists():
+        return _zstd_dicts[int(current.read_text().strip())]
+
+
+def _zstd_dict(dict_id, folder=None):
+    """ the dictionary dict_id, read from folder the first time it is
+        needed since another process may have trained it after this one
+        started, None if it cannot be found """
+    zdict = _zstd_dicts.get(dict_id)
+    if zdict is None and folder is not None:
+        try:
+            data = (Path(folder) / ZSTD_DICTS / str(dict_id)).read_bytes()
+        except FileNotFoundError:
+            return None
+
+        zdict = _zstd_dicts[dict_id] = zstandard.ZstdCompressionDict(data)
+
+    return zdict
+
+
+def train_zstd_dictionary(folder, backend=None, dict_size=112640, max_samples=10000):
+    """ train a zstd dictionary from the existing entries in folder
+        and make it the current dictionary for new entries """
+    if zstandard is None:
+        raise ModuleNotFoundError('training a dictionary requires zstandard')
+
+    folder = Path(folder)
+    if backend is None:
+        backend = _default_backend()
+
+    store = _make_store(backend, folder)
+    _load_zstd_dicts(folder)  # in case entries were compressed with an older dict
+    samples = []
+    for key in store.keys():
+        data = store.get(key)
+        if data is not None:
+            data = decompress(data, folder)
+            if data is None:
+                continue
+
+            samples.append(data)
+            if len(samples) >= max_samples:
+                break
+
+    zdict = zstandard.train_dictionary(dict_size, samples)
+    ddir = folder / ZSTD_DICTS
+    ddir.mkdir(exist_ok=True)
+    dict_id = zdict.dict_id()
+    (ddir / str(dict_id)).write_bytes(zdict.as_bytes())
+    (ddir / 'current').write_text(str(dict_id))
+    _zstd_dicts[dict_id] = zdict
+    log.info(f'trained zstd dictionary {dict_id} on {len(samples)} entries for {folder}')
+    return zdict
+
+
+def compressor(compress, zdict=None):
+    """ return a function that compresses serialized entries """
+    if compress is None:
+        return
+
+    if compress == 'zstd' and zstandard is None:
+        log.warning('zstandard is not installed, falling back to gzip')
+        compress = 'gzip'
+
+    if compress == 'gzip':
+        def compress(data):
+            return gzip.compress(data, compresslevel=6)
+
+    elif compress == 'zstd':
+        def compress(data):
+            # compressors are not thread safe so make one per call
+            return zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=zdict).compress(data)
+
+    else:
+        raise TypeError(f'Bad compression format. {compress!r}')
+
+    return compress
+
+
+def decompress(data, folder=None):
+    """ transparently handle compressed and uncompressed entries, folder
+        is where to look for zstd dictionaries that have not been loaded
+        yet, None if the dictionary for an entry cannot be found """
+    if data[:2] == _GZIP_MAGIC:
+        return gzip.decompress(data)
+    elif data[:4] == _ZSTD_MAGIC:
+        if zstandard is None:
+            raise ModuleNotFoundError('entry is zstd compressed but zstandard is not installed')
+
+        dict_id = zstandard.get_frame_parameters(data).dict_id
+        zdict = None
+        if dict_id:
+            zdict = _zstd_dict(dict_id, folder)
+            if zdict is None:
+                log.warning(f'missing zstd dictionary {dict_id} for {folder}')
+                return None
+
+        return zstandard.ZstdDecompressor(dict_data=zdict).decompress(data)
+    else:
+        return data
+
+
+## storage
+
+EntryStat = namedtuple('EntryStat', ['st_size', 'st_mtime', 'st_ctime'])
+EntryUse = namedtuple('EntryUse', ['key', 'size', 'atime', 'hits'])
+
+
+class FileStore:
+    """ one file per cache key under the namespace folder, either
+        directly in the folder (flat) or fanned out under two levels
+        of subfolders e.g. ab/cd/abcd... (sharded) so that directory
+        operations stay fast with millions of entries """
+
+    layouts = 'flat', 'sharded'
+
+    def __init__(self, folder, layout='flat'):
+        if layout not in self.layouts:
+            raise TypeError(f'Bad cache layout. {layout!r}')
+
+        self.folder = folder
+        self.layout = layout
+
+    def _flat(self, key):
+        return self.folder / key
+
+    def _sharded(self, key):
+        return self.folder / key[:2] / key[2:4] / key
+
+    def _paths(self, key):
+        # the other layout is always checked second so that reads
+        # keep working while migrate_layout is moving entries
+        if self.layout == 'sharded':
+            return self._sharded(key), self._flat(key)
+        else:
+            return self._flat(key), self._sharded(key)
+
+    def path(self, key):
+        primary, secondary = self._paths(key)
+        if not primary.exists() and secondary.exists():
+            return secondary
+
+        return primary
+
+    def get(self, key):
+        for path in self._paths(key):
+            try:
+                with open(path, 'rb') as f:
+                    return f.read()
+            except FileNotFoundError:
+                pass
+
+    def stat(self, key):
+        for path in self._paths(key):
+            try:
+                return path.stat()
+            except FileNotFoundError:
+                pass
+
+    def put(self, key, data):
+        # write to a temp file and rename so that readers never
+        # see a partial entry even if the writer dies midway
+        path, other = self._paths(key)
+        try:
+            fd, temp = tempfile.mkstemp(dir=path.parent, prefix=f'.{key}.', suffix='.tmp')
+        except FileNotFoundError:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd, temp = tempfile.mkstemp(dir=path.parent, prefix=f'.{key}.', suffix='.tmp')
+
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+
+            os.chmod(temp, 0o666 & ~_umask)
+            os.replace(temp, path)
+        except BaseException as e:
+            try:
+                os.unlink(temp)
+            except FileNotFoundError:
+                pass
+
+            raise e
+
+        try:
+            other.unlink()  # don't leave a stale copy in the other layout
+        except FileNotFoundError:
+            pass
+
+    def touch(self, key):
+        for path in self._paths(key):
+            try:
+                os.utime(path)
+                return
+            except FileNotFoundError:
+                pass
+
+    def access(self, key):
+        # atime is often not updated by the os (noatime, relatime)
+        # so set it explicitly, leaving mtime alone for cooldowns
+        for path in self._paths(key):
+            try:
+                st = path.stat()
+                os.utime(path, ns=(time_ns(), st.st_mtime_ns))
+                return
+            except FileNotFoundError:
+                pass
+
+    def delete(self, key):
+        for path in self._paths(key):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def lock(self, key):
+        return key_lock(self.folder, key)
+
+    def alock(self, key):
+        return akey_lock(self.folder, key)
+
+    @staticmethod
+    def _entries(folder):
+        # skip temp files, .locks, packs, and any other subfolders
+        with os.scandir(folder) as it:
+            for de in it:
+                if not de.name.startswith('.') and _is_hex(de.name) and de.is_file():
+                    yield de.name
+
+    @staticmethod
+    def _shards(folder):
+        with os.scandir(folder) as it:
+            for de in it:
+                if len(de.name) == 2 and de.is_dir() and _is_hex(de.name):
+                    yield Path(de.path)
+
+    def _keys_flat(self):
+        yield from self._entries(self.folder)
+
+    def _keys_sharded(self):
+        for shard in self._shards(self.folder):
+            for subshard in self._shards(shard):
+                yield from self._entries(subshard)
+
+    def keys(self):
+        yield from self._keys_flat()
+        yield from self._keys_sharded()
+
+    def _folders(self):
+        yield self.folder
+        for shard in self._shards(self.folder):
+            yield from self._shards(shard)
+
+    def usage(self):
+        """ EntryUse for every entry, hits are not tracked on disk """
+        for folder in self._folders():
+            with os.scandir(folder) as it:
+                for de in it:
+                    if not de.name.startswith('.') and _is_hex(de.name) and de.is_file():
+                        st = de.stat()
+                        yield EntryUse(de.name, st.st_size, st.st_atime, 0)
+
+    def clean_temp(self, older_than=HOUR):
+        """ remove temp files left behind by writers that died """
+        cutoff = time() - older_than
+        for folder in self._folders():
+            with os.scandir(folder) as it:
+                for de in it:
+                    if (de.name.startswith('.') and de.name.endswith('.tmp') and
+                        de.is_file() and de.stat().st_mtime < cutoff):
+                        try:
+                            os.unlink(de.path)
+                        except FileNotFoundError:
+                            pass
+
+    def clear(self):
+        shutil.rmtree(self.folder)
+        self.folder.mkdir()
+
+
+def _is_hex(string):
+    try:
+        int(string, 16)
+        return True
+    except ValueError:
+        return False
+
+
+def migrate_layout(folder, layout='sharded', workers=16, chunksize=10000):
+    """ move all entries in a file backed cache folder into layout
+
+        entries are renamed in parallel and readers using either
+        layout keep working while the migration is in progress """
+    store = FileStore(Path(folder), layout)
+    keys = store._keys_flat() if layout == 'sharded' else store._keys_sharded()
+
+    def move(key):
+        dest, src = store._paths(key)
+        try:
+            os.replace(src, dest)
+        except FileNotFoundError:
+            if not src.exists():
+                return 0  # someone else got here first
+
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(src, dest)
+
+        return 1
+
+    moved = 0
+    with ThreadPoolExecutor(workers) as executor:
+        while True:
+            # map consumes its whole input so submit in chunks
+            chunk = list(islice(keys, chunksize))
+            if not chunk:
+                break
+
+            moved += sum(executor.map(move, chunk))
+
+    if layout == 'flat':
+        for shard in list(store._shards(store.folder)):
+            for subshard in list(store._shards(shard)):
+                try:
+                    subshard.rmdir()
+                except OSError:
+                    pass  # not empty
+
+            try:
+                shard.rmdir()
+            except OSError:
+                pass
+
+    log.info(f'moved {moved} entries to {layout} layout in {folder}')
+    return moved
+
+
+class SqliteEntry:
+    """ the subset of the pathlib.Path interface that consumers of
+        return_path=True rely on, for entries in a SqliteStore """
+
+    def __init__(self, store, key):
+        self.store = store
+        self.name = key
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.store.dbpath!r}, {self.name!r})'
+
+    def __str__(self):
+        return f'{self.store.dbpath}::{self.name}'
+
+    @property
+    def parent(self):
+        return self.store.folder
+
+    def exists(self):
+        return self.store.stat(self.name) is not None
+
+    def stat(self):
+        st = self.store.stat(self.name)
+        if st is None:
+            raise FileNotFoundError(str(self))
+
+        return st
+
+    def read_bytes(self):
+        data = self.store.get(self.name)
+        if data is None:
+            raise FileNotFoundError(str(self))
+
+        return data
+
+    def unlink(self):
+        self.store.delete(self.name)
+
+
+class SqliteStore:
+    """ all cache keys for a namespace in a single sqlite database
+        running in WAL mode so that readers do not block writers """
+
+    filename = 'cache.sqlite3'
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.dbpath = folder / self.filename
+        self._local = threading.local()
+        self._conn()  # create the schema up front
+
+    def _conn(self):
+        # sqlite connections cannot cross threads or forks
+        # so keep one per thread and reopen after a fork
+        local = self._local
+        pid = os.getpid()
+        if not hasattr(local, 'conn') or local.pid != pid:
+            conn = sqlite3.connect(self.dbpath, timeout=60, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS cache ('
+                         'key TEXT PRIMARY KEY, '
+                         'value BLOB NOT NULL, '
+                         'mtime REAL NOT NULL, '
+                         'atime REAL, '
+                         'hits INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID')
+            columns = [r[1] for r in conn.execute('PRAGMA table_info(cache)')]
+            if 'atime' not in columns:  # databases from before eviction
+                conn.execute('ALTER TABLE cache ADD COLUMN atime REAL')
+                conn.execute('ALTER TABLE cache ADD COLUMN '
+                             'hits INTEGER NOT NULL DEFAULT 0')
+            local.conn = conn
+            local.pid = pid
+
+        return local.conn
+
+    def path(self, key):
+        return SqliteEntry(self, key)
+
+    def get(self, key):
+        row = self._conn().execute(
+            'SELECT value FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is not None:
+            return row[0]
+
+    def stat(self, key):
+        row = self._conn().execute(
+            'SELECT length(value), mtime FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is not None:
+            size, mtime = row
+            return EntryStat(size, mtime, mtime)
+
+    def put(self, key, data):
+        self._conn().execute(
+            'INSERT OR REPLACE INTO cache (key, value, mtime) VALUES (?, ?, ?)',
+            (key, data, time()))
+
+    def touch(self, key):
+        self._conn().execute('UPDATE cache SET mtime = ? WHERE key = ?', (time(), key))
+
+    def access(self, key):
+        self._conn().execute('UPDATE cache SET atime = ?, hits = hits + 1 WHERE key = ?',
+                             (time(), key))
+
+    def delete(self, key):
+        self._conn().execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def lock(self, key):
+        return key_lock(self.folder, key)
+
+    def alock(self, key):
+        return akey_lock(self.folder, key)
+
+    def keys(self):
+        for key, in self._conn().execute('SELECT key FROM cache'):
+            yield key
+
+    def usage(self):
+        for row in self._conn().execute(
+                'SELECT key, length(value), COALESCE(atime, mtime), hits FROM cache'):
+            yield EntryUse(*row)
+
+    def clean_temp(self, older_than=HOUR):
+        pass
+
+    def vacuum(self):
+        """ give the space freed by deleted entries back to the os """
+        self._conn().execute('VACUUM')
+
+    def clear(self):
+        self._conn().execute('DELETE FROM cache')
+
+
+_backends = {
+    'file': FileStore,
+    'sqlite': SqliteStore,
+}
+
+
+def _default_backend():
+    from .config import auth
+    backend = auth.get('cache-backend')
+    return 'file' if backend is None else backend
+
+
+def _default_layout():
+    from .config import auth
+    layout = auth.get('cache-layout')
+    return 'flat' if layout is None else layout
+
+
+def _make_store(backend, folder, layout=None):
+    if backend == 'file':
+        return FileStore(folder, _default_layout() if layout is None else layout)
+    else:
+        return _backends[backend](folder)
+
+
+## packs
+
+PACK_FILENAME = 'cache.pack'
+_PACK_MAGIC = b'IDLIBPK2'
+_pack_header = struct.Struct('>8sQQ')  # magic, count, offset of the dictionaries
+_pack_index = struct.Struct('>32sQQd')  # digest, offset, length, mtime
+_pack_dict = struct.Struct('>IQ')  # dict id, length, then the dictionary
+
+
+class Pack:
+    """ read only single file snapshot of a cache folder, a header, an
+        index sorted by key digest for binary search, the raw entries
+        exactly as they were stored, and the zstd dictionaries that
+        those entries need, all read through mmap """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.count, offset = _pack_header.unpack_from(self._mmap, 0)
+        if magic != _PACK_MAGIC:
+            raise ValueError(f'not a cache pack {self.path}')
+
+        # the folder the pack was copied to may have no .zstd-dicts
+        while offset < len(self._mmap):
+            dict_id, length = _pack_dict.unpack_from(self._mmap, offset)
+            offset += _pack_dict.size
+            if dict_id not in _zstd_dicts and zstandard is not None:
+                _zstd_dicts[dict_id] = zstandard.ZstdCompressionDict(
+                    self._mmap[offset:offset + length])
+
+            offset += length
+
+    def _find(self, key):
+        try:
+            digest = bytes.fromhex(key)
+        except ValueError:
+            return None
+
+        lo, hi = 0, self.count
+        size, start = _pack_index.size, _pack_header.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            record = _pack_index.unpack_from(self._mmap, start + mid * size)
+            if record[0] < digest:
+                lo = mid + 1
+            elif record[0] > digest:
+                hi = mid
+            else:
+                return record
+
+    def get(self, key):
+        record = self._find(key)
+        if record is not None:
+            _, offset, length, _ = record
+            return self._mmap[offset:offset + length]
+
+    def stat(self, key):
+        record = self._find(key)
+        if record is not None:
+            _, _, length, mtime = record
+            return EntryStat(length, mtime, mtime)
+
+    def keys(self):
+        size, start = _pack_index.size, _pack_header.size
+        for i in range(self.count):
+            yield _pack_index.unpack_from(self._mmap, start + i * size)[0].hex()
+
+
+def build_pack(folder, backend=None, path=None):
+    """ write every entry in folder to a pack, by default folder/cache.pack
+        where the cache decorator will find it, copy it to another machine
+        to start there with a warm cache """
+    folder = Path(folder)
+    if backend is None:
+        backend = _default_backend()
+
+    if path is None:
+        path = folder / PACK_FILENAME
+
+    store = _make_store(backend, folder)
+    keys = sorted(k for k in store.keys() if len(k) == 64 and _is_hex(k))
+    start = _pack_header.size + _pack_index.size * len(keys)
+    fd, temp = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.seek(start)
+            index = []
+            dict_ids = set()
+            offset = start
+            for key in keys:
+                data, st = store.get(key), store.stat(key)
+                if data is None:  # deleted while we were working
+                    continue
+
+                if data[:4] == _ZSTD_MAGIC and zstandard is not None:
+                    dict_ids.add(zstandard.get_frame_parameters(data).dict_id)
+
+                f.write(data)
+                index.append(_pack_index.pack(bytes.fromhex(key), offset, len(data),
+                                              st.st_mtime))
+                offset += len(data)
+
+            dicts_offset = offset
+            for dict_id in sorted(dict_ids - {0}):
+                # versions share the dictionaries of their root folder
+                zdict = _zstd_dict(dict_id, folder) or _zstd_dict(dict_id, folder.parent)
+                if zdict is None:
+                    log.warning(f'missing zstd dictionary {dict_id} for {folder}')
+                    continue
+
+                data = zdict.as_bytes()
+                f.write(_pack_dict.pack(dict_id, len(data)) + data)
+                offset += _pack_dict.size + len(data)
+
+            # offsets are absolute so if any entries vanished the
+            # unused index slots are simply left as a gap
+            f.seek(0)
+            f.write(_pack_header.pack(_PACK_MAGIC, len(index), dicts_offset))
+            f.write(b''.join(index))
+
+        os.chmod(temp, 0o666 & ~_umask)
+        os.replace(temp, path)
+    except BaseException as e:
+        try:
+            os.unlink(temp)
+        except FileNotFoundError:
+            pass
+
+        raise e
+
+    log.info(f'packed {len(index)} entries {offset} bytes from {folder} to {path}')
+    return path
+
+
+class PackEntry(SqliteEntry):
+    """ return_path=True entry for a key that may only be in a pack """
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.store.pack.path!r}, {self.name!r})'
+
+    def __str__(self):
+        return f'{self.store.pack.path}::{self.name}'
+
+
+class PackedStore:
+    """ a writable store layered over a read only pack, reads fall
+        through to the pack, writes and deletes only touch the store
+        so newer entries shadow packed ones """
+
+    def __init__(self, store, pack):
+        self.store = store
+        self.pack = pack
+        self.folder = store.folder
+
+    def path(self, key):
+        if self.store.stat(key) is None and self.pack.stat(key) is not None:
+            return PackEntry(self, key)
+
+        return self.store.path(key)
+
+    def get(self, key):
+        data = self.store.get(key)
+        return self.pack.get(key) if data is None else data
+
+    def stat(self, key):
+        st = self.store.stat(key)
+        return self.pack.stat(key) if st is None else st
+
+    def put(self, key, data):
+        self.store.put(key, data)
+
+    def touch(self, key):
+        self.store.touch(key)
+
+    def access(self, key):
+        self.store.access(key)
+
+    def delete(self, key):
+        self.store.delete(key)
+
+    def lock(self, key):
+        return self.store.lock(key)
+
+    def alock(self, key):
+        return self.store.alock(key)
+
+    def keys(self):
+        seen = set(self.store.keys())
+        yield from seen
+        yield from (k for k in self.pack.keys() if k not in seen)
+
+    def usage(self):
+        # the pack is read only so it cannot be evicted from
+        return self.store.usage()
+
+    def clean_temp(self, *args, **kwargs):
+        self.store.clean_temp(*args, **kwargs)
+
+    def clear(self):
+        # the store owns the folder so this also removes the pack file
+        self.store.clear()
+        self.pack = _no_pack
+
+
+class _NoPack:
+    path = None
+    def get(self, key): return None
+    def stat(self, key): return None
+    def keys(self): return iter(())
+
+
+_no_pack = _NoPack()
+
+
+## eviction
+
+EVICT_EVERY = 1000  # writes between inline eviction passes
+EVICT_TO = 0.9  # evict down to this fraction of the cap to avoid thrashing
+_evicting = {}  # folder -> lock held while an inline eviction runs
+_units = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+
+
+def parse_size(size):
+    """ bytes from an int or a string like 500M or 2G """
+    if size is None or isinstance(size, int):
+        return size
+
+    size = str(size).strip().lower().rstrip('ib')
+    number, unit = (size[:-1], size[-1]) if size[-1:] in _units else (size, '')
+    return int(float(number) * _units[unit])
+
+
+def _default_max_bytes():
+    from .config import auth
+    return parse_size(auth.get('cache-max-bytes'))
+
+
+def _default_max_bytes_total():
+    from .config import auth
+    return parse_size(auth.get('cache-max-bytes-total'))
+
+
+def _default_eviction():
+    from .config import auth
+    eviction = auth.get('cache-eviction')
+    return 'lru' if eviction is None else eviction
+
+
+def _coldness(eviction):
+    # lfu breaks ties in hits by recency, the file backend does not
+    # record hits so lfu degrades to lru there
+    if eviction == 'lru':
+        return lambda use: use.atime
+    elif eviction == 'lfu':
+        return lambda use: (use.hits, use.atime)
+    else:
+        raise TypeError(f'Bad eviction policy. {eviction!r}')
+
+
+def _evict(entries, max_bytes, eviction):
+    """ entries are (store, EntryUse) pairs, coldest are deleted first """
+    total = sum(use.size for _, use in entries)
+    if total <= max_bytes:
+        return 0, 0
+
+    coldness = _coldness(eviction)
+    target = max_bytes * EVICT_TO
+    count, freed = 0, 0
+    for store, use in sorted(entries, key=lambda su: coldness(su[1])):
+        if total - freed <= target:
+            break
+
+        store.delete(use.key)
+        count += 1
+        freed += use.size
+
+    return count, freed
+
+
+def evict(store, max_bytes, eviction='lru'):
+    """ delete the coldest entries in store until it is under max_bytes
+        returns the number of entries and bytes removed """
+    count, freed = _evict([(store, use) for use in store.usage()],
+                          max_bytes, eviction)
+    if count:
+        log.info(f'evicted {count} entries {freed} bytes from {store.folder}')
+
+    return count, freed
+
+
+def namespaces(cache_path):
+    """ stores for every cache folder under cache_path """
+    cache_path = Path(cache_path)
+    for folder in sorted(cache_path.iterdir()):
+        if not folder.is_dir() or folder.name.startswith('.'):
+            continue
+
+        for f in [folder] + sorted(p for p in folder.iterdir() if
+                                   p.name.startswith(VERSION_PREFIX) and p.is_dir()):
+            if (f / SqliteStore.filename).exists():
+                yield SqliteStore(f)
+            else:
+                yield FileStore(f)
+
+
+def gc(cache_path=None, max_bytes=None, max_bytes_total=None, eviction=None):
+    """ evict from every namespace under cache_path down to max_bytes
+        and then from all of them together down to max_bytes_total,
+        defaults come from the cache-max-bytes, cache-max-bytes-total,
+        and cache-eviction auth variables """
+    from .config import auth
+    if cache_path is None:
+        cache_path = auth.get_path('cache-path')
+
+    if max_bytes is None:
+        max_bytes = _default_max_bytes()
+
+    if max_bytes_total is None:
+        max_bytes_total = _default_max_bytes_total()
+
+    if eviction is None:
+        eviction = _default_eviction()
+
+    count, freed = 0, 0
+    stores = list(namespaces(cache_path))
+    for store in stores:
+        store.clean_temp()
+        if max_bytes is not None:
+            c, f = evict(store, max_bytes, eviction)
+            count += c
+            freed += f
+
+    if max_bytes_total is not None:
+        entries = [(store, use) for store in stores for use in store.usage()]
+        c, f = _evict(entries, max_bytes_total, eviction)
+        count += c
+        freed += f
+
+    if freed:
+        for store in stores:
+            if hasattr(store, 'vacuum'):
+                store.vacuum()
+
+    log.info(f'gc removed {count} entries {freed} bytes from {cache_path}')
+    return count, freed
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(prog='idlib-cache', description=
+                                     'manage the idlib cache')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('gc', help='evict the coldest entries to stay under the size caps')
+    p.add_argument('--cache-path', help='defaults to the cache-path auth variable')
+    p.add_argument('--max-bytes', type=parse_size, help='per namespace cap, e.g. 500M')
+    p.add_argument('--max-bytes-total', type=parse_size, help='overall cap, e.g. 5G')
+    p.add_argument('--eviction', choices=('lru', 'lfu'))
+    p = sub.add_parser('pack', help='build read only packs to copy to other machines')
+    p.add_argument('folders', nargs='+', help='cache folders e.g. ~/.cache/idlib/doi_json')
+    p.add_argument('--backend', choices=tuple(_backends))
+    args = parser.parse_args()
+    if args.command == 'gc':
+        count, freed = gc(args.cache_path, args.max_bytes,
+                          args.max_bytes_total, args.eviction)
+        print(f'removed {count} entries {freed} bytes')
+    elif args.command == 'pack':
+        for folder in args.folders:
+            print(build_pack(Path(folder).expanduser(), args.backend))
+
+
+## blobs
+
+class BlobStore(FileStore):
+    """ content addressed files for bodies too large to keep in a cache
+        entry, named by sha256 so identical bodies are stored once, the
+        layout is that of a sharded FileStore so gc sees and evicts them
+        like any other entry, written through a temp file and renamed so
+        readers never see a partial blob, reads are mmaps so nothing is
+        copied """
+
+    def __init__(self, folder):
+        super().__init__(Path(folder), layout='sharded')
+
+    def __contains__(self, digest):
+        return self.stat(digest) is not None
+
+    def put_chunks(self, chunks):
+        """ write chunks without holding them in memory, returns
+            (digest, size), if chunks raises nothing is stored """
+        self.folder.mkdir(parents=True, exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=self.folder, prefix='.blob.', suffix='.tmp')
+        try:
+            m = hashlib.sha256()
+            size = 0
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    m.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+
+            digest = m.hexdigest()
+            path = self.path(digest)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            os.chmod(temp, 0o666 & ~_umask)
+            os.replace(temp, path)
+        except BaseException as e:
+            try:
+                os.unlink(temp)
+            except FileNotFoundError:
+                pass
+
+            raise e
+
+        return digest, size
+
+    def open(self, digest):
+        """ read only mmap of the blob, it supports read, seek, and
+            slicing like a file or bytes, empty blobs are empty bytes
+            since an empty file cannot be mapped """
+        with open(self.path(digest), 'rb') as f:
+            self.access(digest)  # so that lru eviction sees the read
+            if os.fstat(f.fileno()).st_size == 0:
+                return b''
+
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+## versions
+
+VERSION_PREFIX = 'v-'
+VERSION_GRACE = DAY  # seconds a stale version folder is kept around
+
+
+def fingerprint(*parts):
+    """ short stable hash of the parameters that determine the shape
+        of cached outputs, e.g. request headers or field lists, for use
+        as cache(version=fingerprint(...)) """
+    return hashlib.blake2s(json.dumps(parts, sort_keys=True).encode(),
+                           digest_size=8).hexdigest()
+
+
+def _version_folder(folder, version, root_version=None):
+    if version is None or version == root_version:
+        return folder
+
+    return folder / (VERSION_PREFIX + version)
+
+
+def gc_versions(folder, version, root_version=None, grace=VERSION_GRACE):
+    """ remove version folders under folder that are not version and
+        have not been used for grace seconds, entries in folder itself
+        are only removed when root_version is set and is not version """
+    folder = Path(folder)
+    keep = _version_folder(folder, version, root_version)
+    cutoff = time() - grace
+    removed = []
+    for path in folder.iterdir():
+        if (path.name.startswith(VERSION_PREFIX) and path.is_dir() and
+            path != keep and path.stat().st_mtime < cutoff):
+            log.info(f'removing stale cache version {path}')
+            shutil.rmtree(path, ignore_errors=True)
+            removed.append(path)
+
+    if root_version is not None and keep != folder:
+        # FIXME no way to tell when the root entries were last used
+        # other than by their own mtimes so do it entry by entry
+        root = _make_store(_default_backend(), folder)
+        for key in list(root.keys()):
+            stat = root.stat(key)
+            if stat is not None and stat.st_mtime < cutoff:
+                root.delete(key)
+                removed.append(key)
+
+    return removed
+
+
+def read_entry(path, ser='json'):
+    """ deserialize the entry at a path returned via return_path=True """
+    _, deserialize = _serializers[ser]
+    # dictionaries live in the namespace folder above any shards or versions
+    parent = Path(path.parent)
+    folder = next((f for f in (parent, *parent.parents[:3]) if (f / ZSTD_DICTS).exists()),
+                  None)
+    data = decompress(path.read_bytes(), folder)
+    if data is None:
+        raise FileNotFoundError(f'no zstd dictionary to read {path}')
+
+    output = deserialize(data)
+    if isinstance(output, dict):
+        output.pop(VALIDATORS, None)
+
+    return output
+
+
+def rekey(decorated, calls):
+    """ merge entries cached under keys from before identifiers had
+        asCacheKey into their canonical entry, calls is an iterable of
+        argument tuples as they would be passed to decorated, e.g.
+        rekey(Doi._metadata, [(d, d.identifier) for d in dois])
+
+        entries that duplicate an existing canonical entry are removed
+        returns the number of entries moved and removed """
+    store = decorated.cache_store
+    moved = removed = 0
+    for args in calls:
+        legacy = decorated.cache_key(*args, _canonical=False)
+        canonical = decorated.cache_key(*args)
+        if legacy == canonical:
+            continue
+
+        data = store.get(legacy)
+        if data is None:
+            continue
+
+        with store.lock(canonical):
+            if store.get(canonical) is None:
+                store.put(canonical, data)
+                moved += 1
+            else:
+                removed += 1
+
+            store.delete(legacy)
+            _memory.pop((store.folder, legacy))
+
+    log.info(f'rekeyed {store.folder} moved {moved} removed {removed}')
+    return moved, removed
+
+
+def cache(folder, ser='json', clear_cache=False, create=False, return_path=False, debug=False,
+          backend=None, cooldown=default_cooldown_policy, memory=True, compress=None,
+          layout=None, validators=False, version=None, root_version=None,
+          max_bytes=None, eviction=None, ttl=None):
     """ outer decorator to cache output of a function to a folder
 
         decorated functions accept an additional keyword argument
-        `_refresh_cache` that can be used to force refresh the cache """
-
-    if ser == 'json':
-        serialize = json.dump
-        deserialize = json.load
-        mode = 't'
-    elif ser == 'pickle':
-        serialize = pickle.dump
-        deserialize = pickle.load
-        mode = 'b'
-    else:
+        `_refresh_cache` that can be used to force refresh the cache
+
+        ser is one of `json`, `pickle`, `orjson`, or `msgpack`, the
+        last two fall back to json if they are not installed
+
+        functions may return a dict containing COOLDOWN to cache a
+        failure, cooldown is a function from that dict to the number of
+        seconds it remains valid, see cooldown_policy
+
+        memory controls whether outputs are also kept in the process
+        wide memory tier, see set_memory_limits
+
+        compress may be `gzip` or `zstd` (which falls back to gzip if
+        zstandard is not installed) to compress new entries, entries
+        are always read correctly regardless of how they were written,
+        zstd uses the dictionary from train_zstd_dictionary if present
+
+        backend selects how entries are stored under folder, `file`
+        (the default) uses one file per entry, `sqlite` uses a single
+        database per folder, when backend is None the `cache-backend`
+        auth variable is used
+
+        layout is `flat` or `sharded` for the file backend, when None
+        the `cache-layout` auth variable is used, see migrate_layout
+
+        validators=True stores the ETag, Last-Modified, and Cache-Control
+        headers passed to record_validators alongside the entry, during
+        _refresh_cache the function can send conditional_headers() and
+        return NOT_MODIFIED on a 304 to keep the cached body
+
+        version namespaces entries under folder/v-{version} so that
+        changing it ignores entries cached with the old version, which
+        are removed lazily by gc_versions after VERSION_GRACE, see
+        fingerprint, root_version names the version that entries stored
+        directly in folder were written with before it was versioned
+
+        max_bytes caps the size of the namespace, every EVICT_EVERY
+        writes the coldest entries are evicted in the background by
+        `lru` (last access) or `lfu` (hits, sqlite only) eviction, when
+        None the cache-max-bytes and cache-eviction auth variables are
+        used, see gc for capping all namespaces together
+
+        hits, misses, bytes, and latencies for each folder are
+        available from cache_stats
+
+        if folder contains a pack from build_pack it is used as a read
+        only layer below the backend
+
+        use @decorated.coroutine on an async def version of the function
+        to get an async cached version that shares the same entries
+
+        ttl is the number of seconds after which an entry is fetched
+        again, by default entries never expire """
+
+    if ser not in _serializers:
         raise TypeError('Bad serialization format.')
+    elif ser == 'orjson' and orjson is None or ser == 'msgpack' and msgpack is None:
+        log.warning(f'{ser} is not installed, falling back to json for {folder}')
+
+    serialize, deserialize = _serializers[ser]
+    # memory hits are decoded on every call so use the fastest decoder
+    # that reads what serialize wrote, orjson reads stdlib json too
+    mdeserialize = _orjson_loads if ser == 'json' and orjson is not None else deserialize
+
+    if backend is None:
+        backend = _default_backend()
 
-    write_mode = 'w' + mode
-    read_mode = 'r' + mode
+    if backend not in _backends:
+        raise TypeError(f'Bad cache backend. {backend!r}')
 
     folder = Path(folder)
     if not folder.exists():
@@ -84,52 +1663,296 @@ def cache(folder, ser='json', clear_cache=False, create=False, return_path=False
 
         folder.mkdir(parents=True)
 
+    root = folder
+    folder = _version_folder(root, version, root_version)
+    if folder != root:
+        folder.mkdir(exist_ok=True)
+        os.utime(folder)  # mark this version as still in use for gc_versions
+
+    store = _make_store(backend, folder, layout)
+    if (folder / PACK_FILENAME).exists():
+        store = PackedStore(store, Pack(folder / PACK_FILENAME))
+
+    # load dicts even when not compressing since old entries may need them
+    zdict = _load_zstd_dicts(root)
+    _compress = compressor(compress, zdict)
+
     if clear_cache:
         log.debug(f'clearing cache for {folder}')
-        shutil.rmtree(folder)
-        folder.mkdir()
+        store.clear()
+        _memory.clear()
+
+    if max_bytes is None:
+        max_bytes = _default_max_bytes()
+    else:
+        max_bytes = parse_size(max_bytes)
+
+    if eviction is None:
+        eviction = _default_eviction()
+
+    _coldness(eviction)  # fail early on a bad policy
+    # only pay for recording reads when something will use them
+    track = max_bytes is not None or _default_max_bytes_total() is not None
+    # decorated functions are called from thread pools so the counter
+    # must be atomic, next on a count is, and decorators that share a
+    # folder share its lock so only one eviction runs at a time
+    writes = itertools.count(1)
+    evicting = _evicting.setdefault(folder, threading.Lock())
+    def maybe_evict():
+        if next(writes) % EVICT_EVERY or not evicting.acquire(blocking=False):
+            return
+
+        def run():
+            try:
+                evict(store, max_bytes, eviction)
+            except Exception as e:
+                log.exception(e)
+            finally:
+                evicting.release()
+
+        threading.Thread(target=run, daemon=True).start()
+
+    stats = _namespace_stats(folder)
+    ttl = None if ttl is None else float(ttl)
+    gc_pending = [] if version is None else [True]
+    def collect():
+        try:
+            gc_versions(root, version, root_version)
+        except Exception as e:
+            log.exception(e)
 
     def inner(function):
         spector = argspector(function)
         fn = function.__name__
-        @wraps(function)
-        def superinner(*args, _refresh_cache=False, **kwargs):
-            filename = cache_hash(spector(*args, ____fn=fn, **kwargs))
-            filepath = folder / filename
-            fe = filepath.exists()
-            if fe and not _refresh_cache:
-                log.debug(f'deserializing from {filepath}')
-                with open(filepath, read_mode) as f:
-                    output = deserialize(f)
+        def remember(key, output, data, mtime=None):
+            # data is output serialized, possibly with its validators,
+            # the path is kept so memory hits never touch the disk
+            if memory and not (isinstance(output, dict) and COOLDOWN in output):
+                expires = None
+                if ttl is not None:
+                    expires = (time() if mtime is None else mtime) + ttl
+
+                path = store.path(key) if return_path else None
+                _memory.put((folder, key), (expires, data, path), len(data))
+
+        def load(data, deserialize=deserialize):
+            output = deserialize(data)
+            if isinstance(output, dict) and VALIDATORS in output:
+                return output, output.pop(VALIDATORS)
 
+            return output, None
+
+        def read(key):
+            data = store.get(key)
+            if data is None:
+                return None, None, None
+
+            stats.incr('bytes_read', len(data))
+            data = decompress(data, root)
+            if data is None:  # unreadable so fetch it again
+                return None, None, None
+
+            return (*load(data), data)
+
+        def write(key, output, validators=None):
+            if isinstance(output, dict) and COOLDOWN in output:
+                output[COOLDOWN_TIME] = time()
+
+            if validators and isinstance(output, dict):
+                data = serialize({**output, VALIDATORS: validators})
             else:
-                output = function(*args, **kwargs)
+                data = serialize(output)
+
+            raw = data
+            if _compress is not None:
+                data = _compress(data)
+
+            try:
+                store.put(key, data)
+            except Exception as e:
+                # a full disk should not lose the result we just fetched
+                stats.incr('write_failures')
+                log.exception(e)
+            else:
+                stats.incr('bytes_written', len(data))
+                if max_bytes is not None:
+                    maybe_evict()
+
+            remember(key, output, raw)
+
+        def lookup(key):
+            # how the entry was found, the output, and for memory hits
+            # the path that the entry was read from
+            if memory:
+                entry = _memory.get((folder, key), _miss)
+                if entry is not _miss:
+                    expires, data, path = entry
+                    if expires is None or time() <= expires:
+                        stats.incr('memory_hits')
+                        return 'memory', load(data, mdeserialize)[0], path
+
+            output, _, data = read(key)
+            if data is None:
+                return None, None, None
+
+            if track:
+                store.access(key)
+
+            if (isinstance(output, dict) and COOLDOWN in output and
+                cooldown_expired(output, cooldown, store.stat(key))):
+                log.debug(f'cooldown expired for {store.path(key)}')
+                return None, None, None
+
+            mtime = None
+            if ttl is not None and not (isinstance(output, dict) and COOLDOWN in output):
+                mtime = store.stat(key).st_mtime
+                if mtime + ttl < time():
+                    log.debug(f'ttl expired for {store.path(key)}')
+                    return None, None, None
+
+            remember(key, output, data, mtime)
+            stats.incr('hits')
+            return 'hit', output, None
+
+        def begin(key, revalidate):
+            stats.incr('misses')
+            if gc_pending:
+                # only go looking for stale versions once we have
+                # to go to the network anyway
+                gc_pending.clear()
+                threading.Thread(target=collect, daemon=True).start()
+
+            if not validators:
+                return None, None, None
+
+            old, previous, _ = read(key) if revalidate else (None, None, None)
+            if isinstance(old, dict) and COOLDOWN in old:
+                old, previous = None, None
+
+            return old, previous, {'previous': previous, 'current': None}
+
+        def finish(key, output, old, previous, state):
+            if state is None:
                 if output is not None:
-                    try:
-                        with open(filepath, write_mode) as f:
-                            serialize(output, f)
-                    except Exception as e:
-                        filepath.unlink()
-                        # TODO remove serialization on failure so we
-                        # don't think a real cache exists
-                        raise e
+                    write(key, output)
+
+                return output
+
+            current = state['current']
+            if output is NOT_MODIFIED:
+                if old is None:
+                    raise ValueError(f'{function} returned NOT_MODIFIED without a cached entry')
+
+                log.debug(f'not modified {folder} {key}')
+                stats.incr('not_modified')
+                output = old
+                if current and current != previous:
+                    write(key, output, current)
+                else:
+                    store.touch(key)
+                    remember(key, output, serialize(output))
+
+            elif output is not None:
+                write(key, output, current)
+
+            return output
 
+        def fetch(key, args, kwargs, revalidate):
+            old, previous, state = begin(key, revalidate)
+            token = _validation.set(state)
+            try:
+                output = function(*args, **kwargs)
+            finally:
+                _validation.reset(token)
+
+            return finish(key, output, old, previous, state)
+
+        def result(key, fe, output, path, args, kwargs, start):
             if isinstance(output, dict) and COOLDOWN in output:
                 # a hack to put a dummy variable in the cache
                 # to prevent retrying on a persistent failure case
+                # until the cooldown policy says the entry has expired
                 if fe:
+                    fe = 'cooldown'
+                    stats.incr('cooldown_hits')
                     reason = output[COOLDOWN]
                     msg = f'currently in cooldown for {args} {kwargs} due to {reason}'
                     log.debug(msg)
 
-                # TODO add timing or remove cooldowns function
                 output = None
 
+            stats.observe(fe if fe else 'miss', perf_counter() - start)
             if return_path:
-                return output, filepath
+                return output, store.path(key) if path is None else path
             else:
                 return output
 
+        def cache_key(*args, _canonical=True, **kwargs):
+            return cache_hash(spector(*args, ____fn=fn, **kwargs), canonical=_canonical)
+
+        @wraps(function)
+        def superinner(*args, _refresh_cache=False, **kwargs):
+            start = perf_counter()
+            key = cache_key(*args, **kwargs)
+            fe, output, path = (None, None, None) if _refresh_cache else lookup(key)
+            if fe:
+                log.debug(f'deserializing from {folder} {key}')
+
+            else:
+                # only one thread or process fetches a given key at
+                # a time, the rest wait and then read what it wrote
+                with store.lock(key):
+                    if not _refresh_cache:
+                        fe, output, path = lookup(key)
+
+                    if fe:
+                        log.debug(f'deserializing from {folder} {key} after wait')
+                    else:
+                        output = fetch(key, args, kwargs, _refresh_cache)
+
+            return result(key, fe, output, path, args, kwargs, start)
+
+        def coroutine(afunction):
+            """ decorator for an async def version of function that shares
+                its cache entries, keys, and cooldowns, disk reads and
+                writes are small enough that they are done inline """
+            @wraps(afunction)
+            async def asuperinner(*args, _refresh_cache=False, **kwargs):
+                start = perf_counter()
+                key = cache_key(*args, **kwargs)
+                fe, output, path = (None, None, None) if _refresh_cache else lookup(key)
+                if fe:
+                    log.debug(f'deserializing from {folder} {key}')
+
+                else:
+                    async with store.alock(key):
+                        if not _refresh_cache:
+                            fe, output, path = lookup(key)
+
+                        if fe:
+                            log.debug(f'deserializing from {folder} {key} after wait')
+                        else:
+                            old, previous, state = begin(key, _refresh_cache)
+                            token = _validation.set(state)
+                            try:
+                                output = await afunction(*args, **kwargs)
+                            finally:
+                                _validation.reset(token)
+
+                            output = finish(key, output, old, previous, state)
+
+                return result(key, fe, output, path, args, kwargs, start)
+
+            if debug:
+                @wraps(afunction)
+                async def asuperinner(*args, _refresh_cache=False, **kwargs):
+                    output = await afunction(*args, **kwargs)
+                    return (output, None) if return_path else output
+
+            asuperinner.cache_key = cache_key
+            asuperinner.cache_store = store
+            return asuperinner
+
         if debug:
             if return_path:
                 @wraps(function)
@@ -140,6 +1963,13 @@ def cache(folder, ser='json', clear_cache=False, create=False, return_path=False
                 def superinner(*args, _refresh_cache=False, **kwargs):
                     return function(*args, **kwargs)
 
+        superinner.cache_key = cache_key
+        superinner.cache_store = store
+        superinner.coroutine = coroutine
         return superinner
 
     return inner
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,460 @@
+import os
+import json
+import asyncio
+import threading
+import contextvars
+from time import time, sleep, monotonic
+from functools import partial
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from urllib.parse import urljoin, urlparse
 import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
 from . import exceptions as exc
-from .utils import log
+from .utils import log, current_deadline
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+# bounds on a single resolution chain see resolution_chain_responses
+MAX_HOPS = 20
+CHAIN_TIMEOUT = 60  # seconds for the whole chain
+REQUEST_TIMEOUT = (5, 30)  # connect and read seconds for each request
+
+
+# connections kept alive per host, hosts that we hit hard get more
+POOL_MAXSIZE = 10
+HOST_POOL_MAXSIZE = {
+    'doi.org': 32,
+    'api.crossref.org': 16,
+    'api.datacite.org': 16,
+    'api.ror.org': 16,
+    'pub.orcid.org': 16,
+    'scicrunch.org': 16,
+    'www.protocols.io': 16,
+}
+
+
+# requests per second and burst for hosts with documented limits
+# anything else is unlimited until a response tells us otherwise
+HOST_RATES = {
+    'api.crossref.org': (50, 50),  # X-Rate-Limit-Limit 50 X-Rate-Limit-Interval 1s
+    'api.datacite.org': (10, 30),  # 3000 per 5 minutes
+    'api.ror.org': (6, 20),  # 2000 per 5 minutes
+    'pub.orcid.org': (24, 40),
+}
+RETRIES = 3  # times a 429 or 503 with Retry-After is retried
+MAX_RETRY_AFTER = 120  # longer than this and we give the response to the caller
+MAX_SYNC_WAIT = 20  # seconds a sync request may sleep in total without a deadline
+
+
+def _seconds(value):
+    # Retry-After is either delta seconds or an http date
+    try:
+        return max(0, float(value))
+    except ValueError:
+        try:
+            return max(0, parsedate_to_datetime(value).timestamp() - time())
+        except (TypeError, ValueError):
+            return None
+
+
+class TokenBucket:
+    """ rate limit for one host, callers reserve a token and get back
+        how long to wait before using it so nobody spins on a lock """
+
+    def __init__(self, rate=None, burst=None):
+        self._lock = threading.Lock()
+        self.paused_until = 0
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        with self._lock:
+            self.rate = rate
+            self.burst = burst if burst is not None else max(1, rate or 1)
+            self.tokens = self.burst
+            self.updated = monotonic()
+
+    def reserve(self):
+        """ take a token, returns the seconds to wait before using it """
+        with self._lock:
+            now = monotonic()
+            delay = max(0, self.paused_until - now)
+            if self.rate is None:
+                return delay
+
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1  # negative tokens are a queue of reservations
+            if self.tokens < 0:
+                delay = max(delay, -self.tokens / self.rate)
+
+            return delay
+
+    def pause(self, seconds):
+        """ nobody gets a token for seconds, e.g. after a Retry-After """
+        with self._lock:
+            self.paused_until = max(self.paused_until, monotonic() + seconds)
+
+    def paused(self):
+        """ seconds until the pause is over, 0 if there is none """
+        with self._lock:
+            return max(0, self.paused_until - monotonic())
+
+
+class RateLimiter:
+    """ token buckets per host that learn from Retry-After and from
+        X-Rate-Limit-* and X-RateLimit-* response headers """
+
+    def __init__(self, host_rates=None):
+        self._lock = threading.Lock()
+        self.host_rates = dict(HOST_RATES if host_rates is None else host_rates)
+        self._buckets = {}
+
+    def bucket(self, url):
+        host = urlparse(str(url)).netloc
+        with self._lock:
+            if host not in self._buckets:
+                self._buckets[host] = TokenBucket(*self.host_rates.get(host, (None, None)))
+
+            return self._buckets[host]
+
+    def reserve(self, url):
+        return self.bucket(url).reserve()
+
+    def backoff(self, url, seconds):
+        """ pause all requests to the host of url """
+        log.info(f'backing off {urlparse(str(url)).netloc} for {seconds}s')
+        self.bucket(url).pause(seconds)
+
+    def paused(self, url):
+        return self.bucket(url).paused()
+
+    def learn(self, resp):
+        """ update the bucket for resp.url from its headers, returns the
+            seconds to wait before a retry if resp should be retried """
+        headers = resp.headers
+        bucket = self.bucket(resp.url)
+        if 'X-Rate-Limit-Limit' in headers and 'X-Rate-Limit-Interval' in headers:
+            # crossref style, the interval looks like 1s
+            try:
+                limit = int(headers['X-Rate-Limit-Limit'])
+                interval = float(headers['X-Rate-Limit-Interval'].rstrip('s'))
+                rate = limit / interval
+                if rate != bucket.rate:
+                    bucket.set_rate(rate, limit)
+            except ValueError:
+                pass
+
+        if headers.get('X-RateLimit-Remaining') == '0' and 'X-RateLimit-Reset' in headers:
+            # the reset is usually epoch seconds but sometimes delta seconds
+            reset = _seconds(headers['X-RateLimit-Reset'])
+            if reset is not None:
+                bucket.pause(reset - time() if reset > 10 ** 9 else reset)
+
+        if resp.status_code in (429, 503):
+            wait = _seconds(headers['Retry-After']) if 'Retry-After' in headers else None
+            if wait is not None:
+                bucket.pause(wait)
+                return wait
+
+
+rate_limiter = RateLimiter()
+
+
+def _request_timeout(timeout, url):
+    """ REQUEST_TIMEOUT when no timeout is given, capped by the deadline """
+    timeout = REQUEST_TIMEOUT if timeout is None else timeout
+    d = current_deadline()
+    return timeout if d is None else d.cap(timeout, f'before {url}')
+
+
+def _fits(wait, waited=None):
+    """ whether waiting wait seconds still leaves time for a request,
+        sync callers pass the seconds they have already slept so that
+        without a deadline they hold their thread for MAX_SYNC_WAIT at
+        most, async callers park instead and are only bound by deadlines """
+    d = current_deadline()
+    if d is not None:
+        return wait < d.remaining()
+
+    return waited is None or waited + wait <= MAX_SYNC_WAIT
+
+
+def _wait(delay, url, waited=None):
+    if not _fits(delay, waited):
+        if current_deadline() is None:
+            msg = f'not blocking for {delay:.2f}s on the rate limit for {url}'
+            raise exc.AccessLimitError(msg)
+
+        msg = f'deadline exceeded waiting {delay:.2f}s for the rate limit on {url}'
+        raise exc.DeadlineExceededError(msg)
+
+    return delay
+
+
+@contextmanager
+def _deadline_errors(url):
+    try:
+        yield
+    except requests.exceptions.Timeout as e:
+        d = current_deadline()
+        if d is not None and d.expired:
+            raise exc.DeadlineExceededError(f'deadline exceeded for {url}') from e
+
+        raise
+
+
+class PooledRequests:
+    """ drop in for the parts of the requests module that we use
+        so that every stream shares keep-alive connection pools
+
+        connection pools are shared between threads, sessions are
+        kept one per thread since cookie handling in requests.Session
+        is not thread safe, and both are recreated after a fork """
+
+    exceptions = requests.exceptions
+    codes = requests.codes
+    Response = requests.Response
+
+    def __init__(self, pool_maxsize=None, host_pool_maxsize=None, limiter=None):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.limiter = rate_limiter if limiter is None else limiter
+        self.transport = None
+        self.configure(pool_maxsize, host_pool_maxsize)
+
+    def configure(self, pool_maxsize=None, host_pool_maxsize=None):
+        """ set the default and per host pool sizes, existing
+            sessions are dropped and connections closed """
+        with self._lock:
+            self.pool_maxsize = POOL_MAXSIZE if pool_maxsize is None else pool_maxsize
+            self.host_pool_maxsize = (dict(HOST_POOL_MAXSIZE) if host_pool_maxsize is None
+                                      else dict(host_pool_maxsize))
+            self._reset()
+
+    def _reset(self):
+        old = getattr(self, '_adapters', {})
+        self._pid = os.getpid()
+        self._generation = getattr(self, '_generation', -1) + 1
+        self._adapters = {}
+        for adapter in old.values():
+            adapter.close()
+
+    def mount(self, transport=None):
+        """ send every request through transport, a requests adapter
+            e.g. idlib.replay.ReplayAdapter, None restores the pools """
+        with self._lock:
+            self.transport = transport
+            self._reset()
+
+    def adapter(self, host):
+        """ the shared adapter for host, None for the default """
+        with self._lock:
+            if self._pid != os.getpid():
+                # never share sockets with the parent process
+                self._reset()
+
+            if host not in self._adapters:
+                size = self.host_pool_maxsize.get(host, self.pool_maxsize)
+                self._adapters[host] = HTTPAdapter(pool_connections=1 if host else 32,
+                                                   pool_maxsize=size)
+
+            return self._adapters[host], self._generation
+
+    def Session(self):
+        """ session for the current thread using the shared pools """
+        local = self._local
+        default, generation = self.adapter(None)
+        if getattr(local, 'generation', None) != generation:
+            session = requests.Session()
+            if self.transport is not None:
+                default = self.transport
+
+            session.mount('http://', default)
+            session.mount('https://', default)
+            for host in ([] if self.transport is not None else self.host_pool_maxsize):
+                adapter, _ = self.adapter(host)
+                session.mount(f'https://{host}/', adapter)
+                session.mount(f'http://{host}/', adapter)
+
+            local.session = session
+            local.generation = generation
+
+        return local.session
+
+    def request(self, method, url, timeout=None, **kwargs):
+        """ every request waits its turn with the rate limiter and
+            429 and 503 responses with a short Retry-After are retried,
+            timeout defaults to REQUEST_TIMEOUT and is capped by the
+            current idlib.utils.deadline, without one all the waiting
+            for a request is capped at MAX_SYNC_WAIT """
+        waited = 0
+        for attempt in range(RETRIES + 1):
+            delay = self.limiter.reserve(url)
+            if delay:
+                log.debug(f'waiting {delay:.2f}s for {url}')
+                sleep(_wait(delay, url, waited))
+                waited += delay
+
+            with _deadline_errors(url):
+                resp = self.Session().request(method, url,
+                                              timeout=_request_timeout(timeout, url),
+                                              **kwargs)
+
+            wait = self.limiter.learn(resp)
+            if (wait is None or wait > MAX_RETRY_AFTER or attempt == RETRIES or
+                not _fits(wait, waited)):
+                return resp
+
+            log.debug(f'{resp.status_code} retry in {wait}s for {url}')
+            resp.close()
+
+    def get(self, url, params=None, **kwargs):
+        kwargs.setdefault('allow_redirects', True)
+        return self.request('GET', url, params=params, **kwargs)
+
+    def head(self, url, **kwargs):
+        kwargs.setdefault('allow_redirects', False)
+        return self.request('HEAD', url, **kwargs)
+
+    def post(self, url, data=None, json=None, **kwargs):
+        return self.request('POST', url, data=data, json=json, **kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        delay = self.limiter.reserve(request.url)
+        if delay:
+            sleep(_wait(delay, request.url, 0))
+
+        with _deadline_errors(request.url):
+            resp = self.Session().send(request,
+                                       timeout=_request_timeout(timeout, request.url),
+                                       **kwargs)
+
+        self.limiter.learn(resp)
+        return resp
+
+
+pooled_requests = PooledRequests()
+
+
+async def in_thread(function, *args, **kwargs):
+    """ run a blocking function without blocking the event loop,
+        context variables e.g. cache validators are carried over """
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(None, partial(ctx.run, function, *args, **kwargs))
+
+
+def _to_response(hresp, method):
+    # build a requests.Response so that everything that handles
+    # responses works the same way for sync and async callers
+    resp = requests.Response()
+    resp.status_code = hresp.status_code
+    resp.headers = CaseInsensitiveDict(hresp.headers)
+    resp._content = hresp.content
+    resp.encoding = hresp.encoding
+    resp.reason = hresp.reason_phrase
+    resp.url = str(hresp.url)
+    resp.elapsed = hresp.elapsed
+    resp.request = requests.Request(method, str(hresp.request.url),
+                                    headers=dict(hresp.request.headers)).prepare()
+    return resp
+
+
+class AsyncRequests:
+    """ async counterpart to PooledRequests that returns requests.Response
+        objects, uses one pooled httpx.AsyncClient per event loop if httpx
+        is installed and no transport is mounted, otherwise runs PooledRequests
+        in the default executor """
+
+    exceptions = requests.exceptions
+    codes = requests.codes
+    Response = requests.Response
+
+    def __init__(self, sync=pooled_requests):
+        self.sync = sync
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def client(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            for l in [l for l in self._clients if l.is_closed()]:
+                self._clients.pop(l)
+
+            if loop not in self._clients:
+                # httpx pools per host on its own, keep them all alive
+                limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+                self._clients[loop] = httpx.AsyncClient(limits=limits)
+
+            return self._clients[loop]
+
+    async def aclose(self):
+        """ close the client for the running loop """
+        with self._lock:
+            client = self._clients.pop(asyncio.get_running_loop(), None)
+
+        if client is not None:
+            await client.aclose()
+
+    async def request(self, method, url, headers=None, params=None, allow_redirects=True,
+                      timeout=None, **kwargs):
+        if httpx is None or self.sync.transport is not None:
+            return await in_thread(self.sync.request, method, url, headers=headers,
+                                   params=params, allow_redirects=allow_redirects,
+                                   timeout=timeout, **kwargs)
+
+        kwargs.pop('stream', None)  # bodies are always read
+        limiter = self.sync.limiter
+        for attempt in range(RETRIES + 1):
+            delay = limiter.reserve(url)
+            if delay:  # park this request without blocking the loop
+                await asyncio.sleep(_wait(delay, url))
+
+            htimeout = _request_timeout(timeout, url)
+            if isinstance(htimeout, tuple):
+                connect, read = htimeout
+                htimeout = httpx.Timeout(read, connect=connect)
+
+            try:
+                hresp = await self.client().request(
+                    method, str(url), headers=headers, params=params,
+                    follow_redirects=allow_redirects, timeout=htimeout, **kwargs)
+            except httpx.TimeoutException as e:
+                d = current_deadline()
+                if d is not None and d.expired:
+                    raise exc.DeadlineExceededError(f'deadline exceeded for {url}') from e
+
+                raise requests.exceptions.ReadTimeout(str(e)) from e
+            except httpx.ConnectError as e:
+                raise requests.exceptions.ConnectionError(str(e)) from e
+            except httpx.HTTPError as e:
+                raise requests.exceptions.RequestException(str(e)) from e
+
+            resp = _to_response(hresp, method)
+            wait = limiter.learn(resp)
+            if (wait is None or wait > MAX_RETRY_AFTER or attempt == RETRIES or
+                not _fits(wait)):
+                return resp
+
+    async def get(self, url, params=None, **kwargs):
+        kwargs.setdefault('allow_redirects', True)
+        return await self.request('GET', url, params=params, **kwargs)
+
+    async def head(self, url, **kwargs):
+        kwargs.setdefault('allow_redirects', False)
+        return await self.request('HEAD', url, **kwargs)
+
+    async def post(self, url, data=None, json=None, **kwargs):
+        return await self.request('POST', url, data=data, json=json, **kwargs)
+
+
+apooled_requests = AsyncRequests()
 
 
 def resolution_chain(iri, headers_fun=None):
@@ -10,21 +464,171 @@ def resolution_chain(iri, headers_fun=None):
 
 _user_agent_idiocy = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:136.0) Gecko/20100101 Firefox/136.0'
 
+HOST_CAPABILITIES_TTL = 30 * 24 * 60 * 60  # servers do eventually get fixed
+
+
+class HostCapabilities:
+    """ per host memo of the workarounds that try_get had to use so
+        that later requests to the same host skip the failing ones,
+        kept in memory and persisted as json next to the cache """
+
+    HEAD_BROKEN = 'head-broken'
+    NEEDS_USER_AGENT = 'needs-user-agent'
+    NEEDS_HEADERS = 'needs-headers'
+
+    def __init__(self, path=None, ttl=HOST_CAPABILITIES_TTL):
+        self._path = path
+        self.ttl = ttl
+        self._hosts = None
+        self._lock = threading.Lock()
+
+    @property
+    def path(self):
+        if self._path is None:
+            from .config import auth
+            self._path = auth.get_path('cache-path') / 'host-capabilities.json'
+
+        return self._path
+
+    @staticmethod
+    def host(url):
+        return urlparse(url).netloc
+
+    def _load(self):
+        if self._hosts is None:
+            try:
+                with open(self.path, 'rt') as f:
+                    self._hosts = json.load(f)
+            except FileNotFoundError:
+                self._hosts = {}
+            except (OSError, ValueError) as e:
+                log.warning(f'could not read {self.path} {e!r}')
+                self._hosts = {}
+
+        return self._hosts
+
+    def _save(self, host, entry):
+        """ set the entry for host, None removes it, other processes
+            share the file so it is read again and merged under a lock """
+        from .cache import key_lock
+        path = self.path
+        tmp = path.with_name(f'.{path.name}.{os.getpid()}.{threading.get_ident()}')
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with key_lock(path.parent, path.name):
+                self._hosts = None
+                hosts = self._load()
+                if entry is None:
+                    hosts.pop(host, None)
+                else:
+                    hosts[host] = entry
+
+                with open(tmp, 'wt') as f:
+                    json.dump(hosts, f, indent=1, sort_keys=True)
+
+                os.replace(tmp, path)
+        except OSError as e:
+            # the memo is an optimization, never fail a request over it
+            log.warning(f'could not write {path} {e!r}')
+
+    def get(self, url):
+        host = self.host(url)
+        with self._lock:
+            entry = self._load().get(host)
+            if entry is None:
+                return frozenset()
+
+            if time() - entry['seen'] > self.ttl:
+                return frozenset()
+
+            return frozenset(entry['flags'])
 
-def try_get(s, head, headers_fun=None):
+    def learn(self, url, *flags):
+        host = self.host(url)
+        with self._lock:
+            hosts = self._load()
+            entry = hosts.get(host)
+            if entry is not None and set(flags) == set(entry['flags']) and (
+                    time() - entry['seen'] < self.ttl / 2):
+                return
+
+            self._save(host, {'flags': sorted(flags), 'seen': time()})
+
+    def forget(self, url):
+        host = self.host(url)
+        with self._lock:
+            if self._load().get(host) is not None:
+                self._save(host, None)
+
+    def headers(self, url, headers_fun=None):
+        """ the headers for the request that worked last time,
+            None if HEAD is not known to be broken for the host """
+        flags = self.get(url)
+        if self.HEAD_BROKEN not in flags:
+            return
+
+        headers = {}
+        if self.NEEDS_USER_AGENT in flags:
+            headers['User-Agent'] = _user_agent_idiocy
+
+        if self.NEEDS_HEADERS in flags and headers_fun is not None:
+            # headers_fun still decides which netlocs see auth headers
+            extra = headers_fun(url)
+            if extra is not None:
+                log.warning(f'additional headers were added for {url}')
+                headers.update(extra)
+
+        return headers
+
+
+host_capabilities = HostCapabilities()
+
+
+def known_get(s, url, headers_fun=None, timeout=None):
+    """ go straight to the request that worked last time for a host
+        whose HEAD is known to be broken, None if nothing is known """
+    headers = host_capabilities.headers(url, headers_fun=headers_fun)
+    if headers is None:
+        return
+
+    head = s.get(url, headers=headers or None, stream=True,
+                 allow_redirects=False, timeout=timeout)
+    if not head.ok and head.status_code < 500:
+        # the host changed, find out what works now
+        host_capabilities.forget(url)
+        head.close()
+        head.url = url
+        return try_get(s, head, headers_fun=headers_fun, timeout=timeout)
+
+    head.close()
+    return head
+
+
+def try_get(s, head, headers_fun=None, timeout=None):
     # see whether the server has a bad/broken support for head requests
     # sometimes they return e.g. 400 instead of 405, and really they should
     # just work because they work correctly with get request ...
-    head = s.get(head.url, stream=True)
+    url = head.url
+    # only a HEAD that the server refused says anything about the host
+    # a 5xx is a bad moment for the server not a broken HEAD
+    learn = 400 <= head.status_code < 500
+    # never follow here, the chain has to see and bound every hop
+    head = s.get(url, stream=True, allow_redirects=False, timeout=timeout)
 
     if head.ok:
         log.info(f'bad HEAD implementation {head.url}')
+        if learn:
+            host_capabilities.learn(url, HostCapabilities.HEAD_BROKEN)
     elif head.status_code < 500:
         head.close()
         headers = {'User-Agent': _user_agent_idiocy}
-        head = s.get(head.url, headers=headers, stream=True)
+        head = s.get(url, headers=headers, stream=True, allow_redirects=False,
+                     timeout=timeout)
         if head.ok:
             log.info(f'bad HEAD implementation AND bad User-Agent behavior {head.url}')
+            if learn:
+                host_capabilities.learn(url, HostCapabilities.HEAD_BROKEN,
+                                        HostCapabilities.NEEDS_USER_AGENT)
         else:
             headers = None
             if headers_fun is not None:
@@ -32,7 +636,8 @@ def try_get(s, head, headers_fun=None):
                 # are only sent to the netloc's they are for
                 headers = headers_fun(head.url)
                 if headers is not None:
-                    head = s.get(head.url, headers=headers, stream=True)
+                    head = s.get(head.url, headers=headers, stream=True,
+                                 allow_redirects=False, timeout=timeout)
                     if head.ok:
                         # we log a warning because dereferencing a public id
                         # and encountering a permission boundary is bad
@@ -40,6 +645,9 @@ def try_get(s, head, headers_fun=None):
                         # or at least indicate that it happend in band
                         msg = f'additional headers were added for {head.url}'
                         log.warning(msg)
+                        if learn:
+                            host_capabilities.learn(url, HostCapabilities.HEAD_BROKEN,
+                                                    HostCapabilities.NEEDS_HEADERS)
 
     if not head.ok:
         content = head.content
@@ -55,6 +663,56 @@ def try_get(s, head, headers_fun=None):
     return head
 
 
+async def atry_get(s, head, headers_fun=None, timeout=None):
+    """ async version of try_get, s is an AsyncRequests """
+    url = head.url
+    learn = 400 <= head.status_code < 500  # see try_get
+    head = await s.get(url, allow_redirects=False, timeout=timeout)
+    if head.ok:
+        log.info(f'bad HEAD implementation {url}')
+        if learn:
+            host_capabilities.learn(url, HostCapabilities.HEAD_BROKEN)
+    elif head.status_code < 500:
+        head = await s.get(url, headers={'User-Agent': _user_agent_idiocy},
+                           allow_redirects=False, timeout=timeout)
+        if head.ok:
+            log.info(f'bad HEAD implementation AND bad User-Agent behavior {url}')
+            if learn:
+                host_capabilities.learn(url, HostCapabilities.HEAD_BROKEN,
+                                        HostCapabilities.NEEDS_USER_AGENT)
+        elif headers_fun is not None:
+            headers = headers_fun(url)
+            if headers is not None:
+                head = await s.get(url, headers=headers, allow_redirects=False,
+                                   timeout=timeout)
+                if head.ok:
+                    log.warning(f'additional headers were added for {url}')
+                    if learn:
+                        host_capabilities.learn(url, HostCapabilities.HEAD_BROKEN,
+                                                HostCapabilities.NEEDS_HEADERS)
+
+    if not head.ok and head.content:
+        log.error(f'{head.url} error text {head.text}')
+
+    return head
+
+
+async def aknown_get(s, url, headers_fun=None, timeout=None):
+    """ async version of known_get, s is an AsyncRequests """
+    headers = host_capabilities.headers(url, headers_fun=headers_fun)
+    if headers is None:
+        return
+
+    head = await s.get(url, headers=headers or None, allow_redirects=False,
+                       timeout=timeout)
+    if not head.ok and head.status_code < 500:
+        host_capabilities.forget(url)
+        head.url = url
+        return await atry_get(s, head, headers_fun=headers_fun, timeout=timeout)
+
+    return head
+
+
 def resolution_raise_logic(head):
     """ broken out into its own function for reuse to avoid re-resolving
         in cases where we need to interpose additional operations between
@@ -75,31 +733,149 @@ def resolution_raise_logic(head):
                 raise exc.ResolutionError(msg) from e
 
 
-def resolution_chain_responses(iri, raise_on_final=True, headers_fun=None):
-    #doi = doi  # TODO
-    s = requests.Session()
-    head = s.head(iri, allow_redirects=False)
-    if head.status_code < 400:
-        yield head
-    else:
-        head = try_get(s, head, headers_fun=headers_fun)
-        yield head
+def chain_records(chain):
+    """ json serializable records of a resolution chain, responses keep
+        their url, status, and headers but not their bodies """
+    records = []
+    for r in chain:
+        if r is None:
+            records.append(None)
+        elif isinstance(r, requests.PreparedRequest):
+            records.append({'type': 'request', 'method': r.method, 'url': r.url})
+        else:
+            records.append({'type': 'response',
+                            'method': None if r.request is None else r.request.method,
+                            'url': r.url,
+                            'status_code': r.status_code,
+                            'reason': r.reason,
+                            'headers': {k: v for k, v in r.headers.items()
+                                        if k.lower() != 'set-cookie'},})
+
+    return records
+
+
+def chain_from_records(records):
+    """ rebuild a resolution chain from chain_records, responses are
+        requests.Response objects with empty bodies """
+    chain = []
+    for record in records:
+        if record is None:
+            chain.append(None)
+        elif record['type'] == 'request':
+            chain.append(requests.Request(record['method'], record['url']).prepare())
+        else:
+            resp = requests.Response()
+            resp.status_code = record['status_code']
+            resp.reason = record['reason']
+            resp.url = record['url']
+            resp.headers = CaseInsensitiveDict(record['headers'])
+            resp._content = b''
+            if record['method'] is not None:
+                resp.request = requests.Request(record['method'], record['url']).prepare()
+
+            chain.append(resp)
+
+    return chain
+
+
+class _Bounds:
+    """ hop, loop, and time limits for one resolution chain """
+
+    def __init__(self, iri, max_hops, timeout):
+        self.iri = iri
+        self.max_hops = max_hops
+        self.deadline = None if timeout is None else monotonic() + timeout
+        self.visited = set()
+        self.hops = 0
+        self.chain = []
+
+    def timeout(self):
+        """ connect and read timeouts for the next request """
+        connect, read = REQUEST_TIMEOUT
+        if self.deadline is None:
+            return connect, read
 
-    while head.is_redirect and head.status_code < 400:  # FIXME redirect loop issue
-        yield head.next
+        remaining = self.deadline - monotonic()
+        if remaining <= 0:
+            msg = f'resolution of {self.iri} took too long after {self.hops} hops'
+            raise exc.ResolutionTimeoutError(msg, chain=self.chain)
+
+        return min(connect, remaining), min(read, remaining)
+
+    def visit(self, url, cookie=None):
+        # some servers redirect to the same url after setting a cookie
+        # so it is only a loop if we come back with the same cookies
+        if (url, cookie) in self.visited:
+            msg = f'redirect loop at {url} resolving {self.iri}'
+            raise exc.RedirectLoopError(msg, chain=self.chain)
+
+        self.visited.add((url, cookie))
+
+    def hop(self, url, cookie=None):
+        self.hops += 1
+        if self.max_hops is not None and self.hops > self.max_hops:
+            msg = f'more than {self.max_hops} redirects resolving {self.iri}'
+            raise exc.TooManyRedirectsError(msg, chain=self.chain)
+
+        self.visit(url, cookie)
+
+    @contextmanager
+    def errors(self, url):
+        """ convert transport errors into errors that carry the chain """
         try:
-            head = s.send(head.next)
+            yield
+        except requests.exceptions.TooManyRedirects as e:
+            msg = f'too many redirects at {url} resolving {self.iri}'
+            raise exc.TooManyRedirectsError(msg, chain=self.chain) from e
+        except requests.exceptions.Timeout as e:
+            msg = f'timed out at {url} resolving {self.iri}'
+            raise exc.ResolutionTimeoutError(msg, chain=self.chain) from e
         except requests.exceptions.SSLError as e:
+            msg = f'ssl error at {url} resolving {self.iri}'
             raise exc.InbetweenError(msg) from e
 
-        if head.status_code < 400:
-            yield head
-        else:
-            head = try_get(s, head, headers_fun=headers_fun)
-            yield head
 
-        if not head.is_redirect:
-            break
+def resolution_chain_responses(iri, raise_on_final=True, headers_fun=None,
+                               max_hops=MAX_HOPS, timeout=CHAIN_TIMEOUT):
+    """ yield the responses and redirect requests from iri to its referent
+
+        the chain is bounded by max_hops redirects, by timeout seconds
+        for the whole chain, and by REQUEST_TIMEOUT for each request,
+        going past a bound or looping raises a PartialResolutionError
+        whose chain holds everything resolved up to that point """
+    #doi = doi  # TODO
+    s = pooled_requests  # so that the rate limiter sees every request
+    b = _Bounds(iri, max_hops, timeout)
+    chain = b.chain
+    b.visit(iri)
+    with b.errors(iri):
+        head = known_get(s, iri, headers_fun=headers_fun, timeout=b.timeout())
+        if head is None:
+            head = s.head(iri, allow_redirects=False, timeout=b.timeout())
+            if head.status_code >= 400:
+                head = try_get(s, head, headers_fun=headers_fun, timeout=b.timeout())
+
+    chain.append(head)
+    yield head
+
+    while head.is_redirect and head.status_code < 400:
+        request = head.next
+        b.hop(request.url, request.headers.get('Cookie'))
+        chain.append(request)
+        yield request
+        with b.errors(request.url):
+            known = known_get(s, request.url, headers_fun=headers_fun,
+                              timeout=b.timeout())
+            if known is not None:
+                head = known
+            else:
+                head = s.send(request, allow_redirects=False, timeout=b.timeout())
+                if head.status_code >= 400:
+                    head = try_get(s, head, headers_fun=headers_fun,
+                                   timeout=b.timeout())
+
+        chain.append(head)
+        yield head
 
     if raise_on_final:  # we still want the chain ... null pointer error comes later?
         resolution_raise_logic(head)
@@ -114,3 +890,47 @@ def resolution_chain_responses(iri, raise_on_final=True, headers_fun=None):
         # final element of the chain dereference to nothing instead of
         # assuming that the last element succeeded
         yield None
+
+
+async def aresolution_chain_responses(iri, raise_on_final=True, headers_fun=None,
+                                      max_hops=MAX_HOPS, timeout=CHAIN_TIMEOUT):
+    """ async version of resolution_chain_responses that returns the
+        whole chain as a list since callers always consume all of it """
+    s = apooled_requests
+    b = _Bounds(iri, max_hops, timeout)
+    chain = b.chain
+    b.visit(iri)
+    with b.errors(iri):
+        head = await aknown_get(s, iri, headers_fun=headers_fun, timeout=b.timeout())
+        if head is None:
+            head = await s.head(iri, allow_redirects=False, timeout=b.timeout())
+            if head.status_code >= 400:
+                head = await atry_get(s, head, headers_fun=headers_fun,
+                                      timeout=b.timeout())
+
+    chain.append(head)
+    while head.is_redirect and head.status_code < 400:
+        url = urljoin(head.url, head.headers['Location'])
+        b.hop(url)
+        # match the sync version which includes the redirect request
+        chain.append(requests.Request(head.request.method, url).prepare())
+        with b.errors(url):
+            known = await aknown_get(s, url, headers_fun=headers_fun,
+                                     timeout=b.timeout())
+            if known is not None:
+                head = known
+            else:
+                head = await s.head(url, allow_redirects=False, timeout=b.timeout())
+                if head.status_code >= 400:
+                    head = await atry_get(s, head, headers_fun=headers_fun,
+                                          timeout=b.timeout())
+
+        chain.append(head)
+
+    if raise_on_final:
+        resolution_raise_logic(head)
+
+    if head.status_code >= 400:
+        chain.append(None)
+
+    return list(chain)
@@ -12,6 +12,10 @@ class ConfigurationError(LocalError):
     """ Something went wrong with local configuration. """
 
 
+class DataTooLargeError(LocalError):
+    """ The data stream is larger than the limit that was asked for. """
+
+
 class CouldNotReachError(IdlibError):
     """ Could not reach a remote. """
     # FIXME vs UnreachableError, unreachable seems like
@@ -24,6 +28,11 @@ class CouldNotReachError(IdlibError):
     # where it is in the index but we ...
 
 
+class DeadlineExceededError(CouldNotReachError, TimeoutError):
+    """ The time allowed by idlib.utils.deadline ran out before
+        the remote answered. """
+
+
 class CouldNotReachIndexError(CouldNotReachError):
     """ Failure on the way to remote index. """
 
@@ -69,6 +78,27 @@ class ResolutionError(IdlibError):
     # of the IdExistsButError cases
 
 
+class PartialResolutionError(ResolutionError):
+    """ resolution was stopped part way along a redirect chain,
+        chain holds everything that was resolved before stopping """
+
+    def __init__(self, *args, chain=None):
+        super().__init__(*args)
+        self.chain = [] if chain is None else chain
+
+
+class RedirectLoopError(PartialResolutionError):
+    """ a redirect pointed back to a url already in the chain """
+
+
+class TooManyRedirectsError(PartialResolutionError):
+    """ the chain is longer than the maximum number of hops """
+
+
+class ResolutionTimeoutError(PartialResolutionError, TimeoutError):
+    """ the whole chain or a single request took too long """
+
+
 class MalformedIdentifierError(IdlibError):
     """ Your input cannot be determined to be of the
         type of the identifier you want, therefor we will
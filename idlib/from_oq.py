@@ -1,6 +1,6 @@
 import re
 import json
-from time import time, sleep
+from time import time
 from datetime import datetime
 from urllib.parse import urlparse
 import orthauth as oa
@@ -11,19 +11,36 @@ from idlib import formats
 from idlib import streams
 from idlib import exceptions as exc
 from idlib import conventions as conv
-from idlib.cache import cache, COOLDOWN
+from idlib.cache import (cache,
+                         cooldown_policy,
+                         read_entry,
+                         COOLDOWN,
+                         COOLDOWN_TTLS,
+                         MINUTE,
+                         DAY,)
+from idlib.core import rate_limiter
 from idlib.utils import (log,
                          timeout,
                          TZLOCAL,
                          cache_result,
+                         resp_json,
                          base32_pio_encode,
                          base32_pio_decode)
 from idlib.config import auth
 
 
-def path_older_than_day(path):
-    ps = path.stat()
-    return time() - ps.st_ctime > (60 * 60 * 24)
+# pio status codes take precedence over the http status
+pio_cooldown_policy = cooldown_policy(
+    {**COOLDOWN_TTLS,
+     1: 30 * DAY,  # v4 invalid uri, aka does not exist
+     212: 30 * DAY,  # does not exist
+     205: DAY,  # access requested, not authorized
+     250: DAY,  # access requested, not authorized
+     1218: 10 * MINUTE,  # bad authorization header
+     1219: 10 * MINUTE,  # access token expired
+     1266: 10,  # rate limit exceeded
+    },
+    status_keys=('pio_status_code', 'http_status_code'))
 
 
 # from neurondm.simple
@@ -378,6 +395,7 @@ class Pio(formats.Rdf, idlib.Stream):
 
     identifier_actionable = streams.StreamUri.identifier_actionable
     dereference_chain = streams.StreamUri.dereference_chain
+    adereference_chain = streams.StreamUri.adereference_chain
     dereference = streams.StreamUri.dereference
     progenitor = streams.StreamUri.progenitor
     headers = streams.StreamUri.headers
@@ -455,17 +473,30 @@ class Pio(formats.Rdf, idlib.Stream):
                     hrm = self.__class__(self.identifier.uri_human)
                     data = hrm.data1(noh=True)
                 else:
+                    api = self.identifier.uri_api
                     tries = 2
                     for _try in range(tries):
                         try:
-                            data = self.data4()  # XXX data1 cannot bootstrap itself right now
+                            # XXX data1 cannot bootstrap itself right now
+                            data = self.data4(try_refresh_cache=_try > 0)
                             break
                         except exc.AccessLimitError as e:
-                            # FIXME this is SO dumb but we have no data from remote
-                            sleep(self._wait_time - 1)
+                            # fail fast while the host is paused, a retry
+                            # would block this thread in the rate limiter
+                            # until the pause is over
+                            if rate_limiter.paused(api):
+                                raise e
+
                             if _try == (tries - 1):
+                                # we have no Retry-After from remote so pause
+                                # every request to the host instead of letting
+                                # others keep hammering it
+                                rate_limiter.backoff(api, self._wait_time - 1)
                                 raise e
 
+                            # the first failure may be a stale cooldown
+                            # entry so refresh it once
+
             except exc.RemoteError as e:
                 data = None
                 try:
@@ -688,9 +719,7 @@ class Pio(formats.Rdf, idlib.Stream):
                     # conditions under which this assumption goes bad
                     return
 
-                with open(path, 'rt') as f:
-                    blob = json.load(f)
-
+                blob = read_entry(path)
                 message = blob[COOLDOWN]
                 if 'pio_status_code' not in blob:
                     log.critical(blob)
@@ -703,16 +732,12 @@ class Pio(formats.Rdf, idlib.Stream):
                     if fail_ok: return
                     raise exc.IdDoesNotExistError(message)
                 elif sc in (250, 205):  # access requested, not authorized
-                    if path_older_than_day(path):
-                        # there seems to be a case where a protocol is shared
-                        # with us and there is an old cache, in that case we
-                        # hit an infinite loop because getting data for the
-                        # progenitor says we should be able to resolve the
-                        # final protocol now but it was cached on cooldown, if
-                        # we can get to the first progenitor then we likely
-                        # have access to the final url and get will succeed
-                        return self.data4(fail_ok=fail_ok, try_refresh_cache=True)
-
+                    # NOTE these expire after a day via pio_cooldown_policy
+                    # there seems to be a case where a protocol is shared
+                    # with us and there is an old cache, in that case we
+                    # hit an infinite loop because getting data for the
+                    # progenitor says we should be able to resolve the
+                    # final protocol now but it was cached on cooldown
                     try:
                         # there might be a private id in the progenitor chain
                         nself = self.progenitor(type='id-converted-from')
@@ -732,8 +757,8 @@ class Pio(formats.Rdf, idlib.Stream):
                     if fail_ok: return
                     raise exc.NotAuthorizedError(message)
                 elif sc in (429,):  # too many requests
+                    # the cooldown expires in seconds via pio_cooldown_policy
                     if fail_ok: return
-                    path.unlink()  # hopefully works next time?
                     raise exc.AccessLimitError(message)
                 elif sc in (400,):
                     # probably trying to get a pio.view:*.json url
@@ -761,7 +786,6 @@ class Pio(formats.Rdf, idlib.Stream):
                 elif sc == 1266:
                     msg = 'rate limit exceeded'
                     if fail_ok: return
-                    path.unlink()  # hopefully works next time?
                     raise exc.AccessLimitError(msg)
                 else:
                     msg = f'unhandled pio status code {sc}\n' + message
@@ -1851,7 +1875,8 @@ class Pio(formats.Rdf, idlib.Stream):
         eq, user_jwt, rest = after.split('"', 2)
         return user_jwt
 
-    @cache(auth.get_path('cache-path') / 'protocol_json', create=True, return_path=True, debug=False)
+    @cache(auth.get_path('cache-path') / 'protocol_json', create=True, return_path=True, debug=False,
+           cooldown=pio_cooldown_policy, compress=auth.get('cache-compress'))
     def _get_data(self, apiuri):
         """ use apiuri as the identifier since it is distinct
             from other views of the protocol e.g. uri_human etc. """
@@ -1907,7 +1932,7 @@ class Pio(formats.Rdf, idlib.Stream):
         self._progenitors['stream-http'] = resp
         if resp.ok:
             try:
-                j = resp.json()  # the api is reasonably consistent
+                j = resp_json(resp)  # the api is reasonably consistent
                 return j
             except Exception as e:
                 log.exception(e)
@@ -2159,6 +2184,7 @@ class PioUser(idlib.HelperNoData, idlib.Stream):
 
     identifier_actionable = streams.StreamUri.identifier_actionable
     dereference_chain = streams.StreamUri.dereference_chain
+    adereference_chain = streams.StreamUri.adereference_chain
     dereference = streams.StreamUri.dereference
     progenitor = streams.StreamUri.progenitor
     headers = streams.StreamUri.headers
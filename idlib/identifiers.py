@@ -76,6 +76,13 @@ class Identifier(idlib.Stream):  # TODO decide if str should be base ...
     def data(self):
         raise NotImplementedError
 
+    def asCacheKey(self):
+        """ The string used in place of str(self) when this identifier
+            is an argument to a function decorated with idlib.cache.cache
+            identifiers that are equivalent under the rules of their
+            system should return the same value so they share one entry """
+        return str(self)
+
     def asLocal(self, conventions=None):
         if conventions is None:
             conventions = self._local_conventions
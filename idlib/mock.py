@@ -0,0 +1,337 @@
+""" a local stand in for the remote resolvers for load testing
+
+    MockResolver is an asyncio http server that answers for any host,
+    doi.org, api.crossref.org, api.datacite.org, api.ror.org,
+    pub.orcid.org, scicrunch.org, www.protocols.io, etc. from fixture
+    routes, and can add latency, per host rate limits that answer 429
+    with Retry-After, and bursts of 503s
+
+    routes use the same records as an idlib.replay corpus so anything
+    recorded from the real services can be served, a fixture file may
+    also give a route body as text or json instead of base64
+
+    [{"method": "GET", "url": "https://doi.org/10.1234/x",
+      "accept": null, "status_code": 302,
+      "headers": {"Location": "https://example.org/x"}, "text": ""}]
+
+    using the server as a context manager mounts a MockTransport on
+    idlib.core.pooled_requests which rewrites every request to go to
+    the server and the original urls back onto the responses, so the
+    prefix maps, identifiers, and redirect chains are unchanged
+
+    with MockResolver.from_corpus('corpus.jsonl.gz', latency=0.05):
+        idlib.Doi('10.1101/2020.10.19.343129').metadata() """
+
+import json
+import gzip
+import base64
+import random
+import asyncio
+import threading
+from math import ceil
+from time import monotonic
+from http import HTTPStatus
+from urllib.parse import urlsplit, urlunsplit
+from collections import defaultdict, deque, Counter
+from requests.adapters import HTTPAdapter
+from idlib.utils import log
+
+HOST_HEADER = 'X-Idlib-Mock-Host'
+SCHEME_HEADER = 'X-Idlib-Mock-Scheme'
+
+
+def _body(record):
+    if 'json' in record:
+        return json.dumps(record['json']).encode()
+    elif 'text' in record:
+        return record['text'].encode()
+    else:
+        return base64.b64decode(record.get('body', ''))
+
+
+class MockResolver:
+    """ serve fixture routes with optional faults
+
+        latency and jitter are seconds added to every response, jitter
+        is drawn from a generator seeded with seed, rate_limits maps a
+        host to requests per second, past that the host answers 429
+        with Retry-After, error_rate is the chance that a request starts
+        a burst of error_burst 503s from its host
+
+        repeated requests get the routes for a url in order and then
+        the last one forever, anything without a route is a 404 """
+
+    def __init__(self, routes=(), latency=0, jitter=0, seed=0, rate_limits=None,
+                 error_rate=0, error_burst=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limits = {} if rate_limits is None else dict(rate_limits)
+        self.error_rate = error_rate
+        self.error_burst = error_burst
+        self._random = random.Random(seed)
+        self._routes = defaultdict(deque)
+        self._windows = defaultdict(deque)
+        self._bursts = Counter()
+        self.counts = Counter()  # (host, status) -> responses
+        self.port = None
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._writers = set()  # open client connections
+        self._mounted = []  # (requests, transport before mounting)
+        for record in routes:
+            self.add(record)
+
+    @classmethod
+    def from_corpus(cls, path, **kwargs):
+        """ serve an idlib.replay corpus """
+        with gzip.open(path, 'rt') as f:
+            return cls([json.loads(line) for line in f], **kwargs)
+
+    @classmethod
+    def from_fixtures(cls, path, **kwargs):
+        """ serve a json list of routes """
+        with open(path, 'rt') as f:
+            return cls(json.load(f), **kwargs)
+
+    def add(self, record):
+        key = (record.get('method', 'GET'), record['url'], record.get('accept'))
+        self._routes[key].append(record)
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.port}'
+
+    def _route(self, method, url, accept):
+        # fall back from the exact accept to any accept for the url
+        # and from HEAD to GET, the same way most servers behave
+        methods = (method, 'GET') if method == 'HEAD' else (method,)
+        for m in methods:
+            for a in (accept, None):
+                queue = self._routes.get((m, url, a))
+                if queue:
+                    return queue.popleft() if len(queue) > 1 else queue[0]
+
+            for (rm, rurl, _), queue in self._routes.items():
+                if rm == m and rurl == url and queue:
+                    return queue[0]
+
+    def _limited(self, host):
+        rate = self.rate_limits.get(host)
+        if rate is None:
+            return
+
+        now = monotonic()
+        window = self._windows[host]
+        while window and now - window[0] >= 1:
+            window.popleft()
+
+        if len(window) >= rate:
+            return max(1, ceil(1 - (now - window[0])))
+
+        window.append(now)
+
+    def _erroring(self, host):
+        if self._bursts[host]:
+            self._bursts[host] -= 1
+            return True
+
+        if self.error_rate and self._random.random() < self.error_rate:
+            self._bursts[host] = self.error_burst - 1
+            return True
+
+    def respond(self, method, url, headers):
+        """ status, headers, body, and delay for one request """
+        host = urlsplit(url).netloc
+        delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0)
+        retry_after = self._limited(host)
+        if retry_after is not None:
+            return 429, {'Retry-After': str(retry_after)}, b'', delay
+
+        if self._erroring(host):
+            return 503, {}, b'', delay
+
+        record = self._route(method, url, headers.get('accept'))
+        if record is None:
+            return 404, {'Content-Type': 'text/plain'}, b'not found', delay
+
+        out_headers = {k: v for k, v in record.get('headers', {}).items()
+                       if k.lower() not in ('content-length', 'transfer-encoding',
+                                            'content-encoding', 'connection')}
+        return record['status_code'], out_headers, _body(record), delay + record.get('delay', 0)
+
+    async def _handle(self, reader, writer):
+        self._writers.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                method, target, _ = line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+
+                    k, v = line.decode('latin-1').split(':', 1)
+                    headers[k.strip().lower()] = v.strip()
+
+                length = int(headers.get('content-length', 0))
+                if length:
+                    await reader.readexactly(length)
+
+                scheme = headers.get(SCHEME_HEADER.lower(), 'https')
+                host = headers.get(HOST_HEADER.lower(), headers.get('host', ''))
+                path, _, query = target.partition('?')
+                url = urlunsplit((scheme, host, path, query, ''))
+                status, out_headers, body, delay = self.respond(method, url, headers)
+                self.counts[host, status] += 1
+                if delay:
+                    await asyncio.sleep(delay)
+
+                try:
+                    reason = HTTPStatus(status).phrase
+                except ValueError:
+                    reason = ''
+
+                head = [f'HTTP/1.1 {status} {reason}']
+                head.extend(f'{k}: {v}' for k, v in out_headers.items())
+                # HEAD gets the length that GET would have but no body
+                head.append(f'Content-Length: {len(body)}')
+                if method == 'HEAD':
+                    body = b''
+
+                writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+            log.debug(f'mock connection dropped {e!r}')
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _close(self):
+        self._server.close()
+        # close the keep-alive connections that are still waiting so
+        # their handlers see eof and return, cancelling them instead
+        # makes asyncio print a CancelledError for every one of them
+        for writer in list(self._writers):
+            writer.close()
+
+        tasks = asyncio.all_tasks() - {asyncio.current_task()}
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=5)
+            for task in pending:
+                task.cancel()
+
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        await self._server.wait_closed()
+
+    def start(self, port=0):
+        """ run the server on its own event loop in a daemon thread """
+        ready = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._server = self._loop.run_until_complete(
+                asyncio.start_server(self._handle, '127.0.0.1', port))
+            self.port = self._server.sockets[0].getsockname()[1]
+            ready.set()
+            self._loop.run_forever()
+            self._loop.run_until_complete(self._close())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop = None
+
+    def mount(self, requests=None):
+        """ point requests, by default the pooled_requests that all
+            streams share, at this server """
+        if requests is None:
+            from idlib.core import pooled_requests as requests
+
+        self._mounted.append((requests, requests.transport))
+        requests.mount(MockTransport(self.url))
+
+    def unmount(self):
+        """ restore everything this server was mounted on """
+        while self._mounted:
+            requests, transport = self._mounted.pop()
+            requests.mount(transport)
+
+    def __enter__(self):
+        if self._loop is None:
+            self.start()
+
+        self.mount()
+        return self
+
+    def __exit__(self, *args):
+        self.unmount()
+        self.stop()
+
+
+class MockTransport(HTTPAdapter):
+    """ send every request to a MockResolver at base, the original
+        scheme and host go along in headers and the original url is
+        put back on the response so nothing above here can tell """
+
+    def __init__(self, base, **kwargs):
+        kwargs.setdefault('pool_maxsize', 64)  # everything goes to one host
+        super().__init__(**kwargs)
+        self.base = urlsplit(base)
+
+    def send(self, request, **kwargs):
+        url = urlsplit(request.url)
+        mocked = request.copy()
+        mocked.url = urlunsplit((self.base.scheme, self.base.netloc,
+                                 url.path, url.query, ''))
+        mocked.headers[HOST_HEADER] = url.netloc
+        mocked.headers[SCHEME_HEADER] = url.scheme
+        resp = super().send(mocked, **kwargs)
+        resp.url = request.url
+        resp.request = request
+        return resp
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(prog='idlib-mock', description=
+                                     'serve recorded routes for load testing')
+    parser.add_argument('routes', help='idlib.replay corpus (.gz) or json fixtures')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--jitter', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--error-burst', type=int, default=1)
+    parser.add_argument('--rate-limit', action='append', default=[],
+                        metavar='HOST=RPS', help='e.g. api.crossref.org=50')
+    args = parser.parse_args()
+    load = (MockResolver.from_corpus if args.routes.endswith('.gz')
+            else MockResolver.from_fixtures)
+    rate_limits = {h: float(r) for h, r in (s.split('=') for s in args.rate_limit)}
+    server = load(args.routes, latency=args.latency, jitter=args.jitter,
+                  error_rate=args.error_rate, error_burst=args.error_burst,
+                  rate_limits=rate_limits)
+    server.start(args.port)
+    print(server.url)
+    try:
+        server._thread.join()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+""" record real http traffic and replay it without a network
+
+    a corpus is a gzipped json lines file with one exchange per line,
+    method, url, accept header, status, reason, headers, body, and
+    elapsed time, redirects are recorded hop by hop so chains replay
+    exactly, both adapters plug in under every stream via
+    idlib.core.pooled_requests which is what Stream._requests is,
+    point IDLIB_CACHE_PATH at an empty folder when benchmarking so
+    that the on disk caches do not answer before the corpus does
+
+    with replay('corpus.jsonl.gz', latency=0.05):
+        idlib.Doi('10.1101/2020.10.19.343129').metadata() """
+
+import io
+import gzip
+import json
+import base64
+import random
+import threading
+from time import sleep
+from datetime import timedelta
+from collections import defaultdict, deque
+from contextlib import contextmanager
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from idlib.utils import log
+
+
+def _key(method, url, headers):
+    # accept is the only request header that changes what comes back
+    return method, url, headers.get('Accept')
+
+
+class RecordAdapter(HTTPAdapter):
+    """ a normal pooled adapter that appends every exchange to path """
+
+    def __init__(self, path, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+
+    def send(self, request, **kwargs):
+        resp = super().send(request, **kwargs)
+        body = resp.content  # read now, requests keeps it for the caller
+        record = {'method': request.method,
+                  'url': request.url,
+                  'accept': request.headers.get('Accept'),
+                  'status_code': resp.status_code,
+                  'reason': resp.reason,
+                  'headers': {k: v for k, v in resp.headers.items()
+                              if k.lower() != 'set-cookie'},
+                  'body': base64.b64encode(body).decode() if body else '',
+                  'elapsed': resp.elapsed.total_seconds(),}
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self._lock:
+            if self._file is None:
+                self._file = gzip.open(self.path, 'at')
+
+            self._file.write(line)
+
+        return resp
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+        super().close()
+
+
+class ReplayAdapter(BaseAdapter):
+    """ answer requests from a recorded corpus
+
+        latency is seconds added to every response, or 'recorded' to
+        use the elapsed time of the original exchange, jitter adds up
+        to that many more seconds drawn from a generator seeded with
+        seed so that runs are repeatable
+
+        repeated requests get the recorded responses in order and then
+        the last one forever, a request that was never recorded raises
+        ConnectionError as if the network were down """
+
+    def __init__(self, path, latency=0, jitter=0, seed=0):
+        super().__init__()
+        self.path = path
+        self.latency = latency
+        self.jitter = jitter
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._exchanges = defaultdict(deque)
+        with gzip.open(path, 'rt') as f:
+            for line in f:
+                record = json.loads(line)
+                key = record['method'], record['url'], record['accept']
+                self._exchanges[key].append(record)
+
+        log.debug(f'{sum(map(len, self._exchanges.values()))} exchanges from {path}')
+
+    def _record(self, request):
+        key = _key(request.method, request.url, request.headers)
+        with self._lock:
+            queue = self._exchanges.get(key)
+            if not queue:
+                msg = f'no recorded response for {key}'
+                raise requests.exceptions.ConnectionError(msg, request=request)
+
+            record = queue.popleft() if len(queue) > 1 else queue[0]
+            delay = self._random.uniform(0, self.jitter) if self.jitter else 0
+
+        if self.latency == 'recorded':
+            delay += record['elapsed']
+        else:
+            delay += self.latency
+
+        return record, delay
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None,
+             proxies=None):
+        record, delay = self._record(request)
+        if delay:
+            sleep(delay)
+
+        body = base64.b64decode(record['body'])
+        resp = requests.Response()
+        resp.status_code = record['status_code']
+        resp.reason = record['reason']
+        resp.headers = CaseInsensitiveDict(record['headers'])
+        resp.encoding = get_encoding_from_headers(resp.headers)
+        resp.url = request.url
+        resp.request = request
+        resp.connection = self
+        resp.elapsed = timedelta(seconds=delay)
+        resp.raw = io.BytesIO(body)
+        resp._content = body
+        return resp
+
+    def close(self):
+        pass
+
+
+@contextmanager
+def record(path, requests=None):
+    """ record everything sent through requests, by default the
+        pooled_requests that all streams share, appending to path """
+    if requests is None:
+        from idlib.core import pooled_requests as requests
+
+    adapter = RecordAdapter(path)
+    old = requests.transport
+    requests.mount(adapter)
+    try:
+        yield adapter
+    finally:
+        requests.mount(old)
+        adapter.close()
+
+
+@contextmanager
+def replay(path, latency=0, jitter=0, seed=0, requests=None):
+    """ answer everything sent through requests from the corpus at path
+        see ReplayAdapter for latency jitter and seed """
+    if requests is None:
+        from idlib.core import pooled_requests as requests
+
+    adapter = ReplayAdapter(path, latency=latency, jitter=jitter, seed=seed)
+    old = requests.transport
+    requests.mount(adapter)
+    try:
+        yield adapter
+    finally:
+        requests.mount(old)
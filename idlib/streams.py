@@ -18,10 +18,19 @@ them.
 # identifies multiple streams collectively, they are most distingiushed by
 # the particular type of substream, (e.g. metadata-free, data-homogenous)
 
+import weakref
+import tempfile
 from types import MappingProxyType
 import idlib
 from idlib import exceptions as exc
-from idlib.utils import cache_result, StringProgenitor, log
+from idlib.cache import cache, BlobStore, COOLDOWN
+from idlib.core import chain_records, chain_from_records, _seconds
+from idlib.config import auth
+from idlib.utils import cache_result, StringProgenitor, LRUCache, log
+
+
+DATA_CHUNK_SIZE = 64 * 1024
+DATA_SPOOL_BYTES = 8 * 1024 ** 2  # data_file stays in memory up to this size
 
 
 # TODO it seems like there is a little dance going on between identifiers and local names
@@ -55,11 +64,16 @@ class Stream:
 
     @staticmethod
     def _setup(*args, **kwargs):
-        import requests  # resolver dejoure
-        Stream._requests = requests
-
-        from idlib.core import resolution_chain_responses, resolution_raise_logic
+        # resolver dejoure, a requests compatible pooled session
+        from idlib.core import pooled_requests, apooled_requests
+        Stream._requests = pooled_requests
+        Stream._arequests = apooled_requests
+
+        from idlib.core import (resolution_chain_responses,
+                                aresolution_chain_responses,
+                                resolution_raise_logic)
         Stream._resolution_chain_responses = staticmethod(resolution_chain_responses)
+        Stream._aresolution_chain_responses = staticmethod(aresolution_chain_responses)
         Stream._resolution_raise_logic = staticmethod(resolution_raise_logic)
 
     @classmethod
@@ -298,6 +312,62 @@ class Stream:
     def dereference_chain(self):
         raise NotImplementedError
 
+    async def adereference_chain(self):
+        """ async dereference_chain, streams without a native
+            implementation run the sync version in a thread """
+        from idlib.core import in_thread
+        return await in_thread(self.dereference_chain)
+
+    # resolution chains are kept on disk for cache-chain-ttl seconds
+    # so that warm runs do not walk every redirect chain again, the
+    # key includes the stream class since it determines headers_fun
+    @cache(auth.get_path('cache-path') / 'resolution_chain', create=True,
+           ttl=auth.get('cache-chain-ttl'))
+    def _dereference_chain_records(self, iri):
+        return self._chain_cooldown(iri, chain_records(self._resolution_chain_responses(
+            iri,
+            raise_on_final=False,
+            headers_fun=self._resolution_chain_headers_fun)))
+
+    @_dereference_chain_records.coroutine
+    async def _adereference_chain_records(self, iri):
+        return self._chain_cooldown(iri, chain_records(await self._aresolution_chain_responses(
+            iri,
+            raise_on_final=False,
+            headers_fun=self._resolution_chain_headers_fun)))
+
+    def _chain_cooldown(self, iri, records):
+        """ chains that end in a 5xx or 429 are cached as a cooldown so
+            that the ttl for the status applies instead of cache-chain-ttl,
+            the records are only kept for the call that fetched them """
+        final = [r for r in records if r is not None and r['type'] == 'response'][-1]
+        status = final['status_code']
+        if status < 500 and status != 429:
+            return records
+
+        self._chain_transient = records
+        blob = {COOLDOWN: f'{iri} failed with {status}', 'http_status_code': status}
+        for k, v in final['headers'].items():
+            if k.lower() == 'retry-after' and _seconds(v) is not None:
+                blob['retry_after'] = _seconds(v)
+
+        return blob
+
+    def _chain_transient_progenitors(self, iri):
+        """ the chain for a cooldown, only the fetching call has it """
+        records = self.__dict__.pop('_chain_transient', None)
+        if records is None:
+            msg = f'{iri} is in cooldown after a remote failure'
+            raise exc.ExistenceUnknownError(msg)
+
+        return self._chain_progenitors(records)
+
+    @staticmethod
+    def _chain_progenitors(records):
+        return tuple(
+            resp if resp is None else StringProgenitor(resp.url, progenitor=resp)
+            for resp in chain_from_records(records))
+
     def dereference(self, asType=None):
         """ Many identifier systems have native dereferincing semantics
 
@@ -350,6 +420,12 @@ class Stream:
             should return None or error on these. """
         raise NotImplementedError
 
+    async def ametadata(self):
+        """ async metadata, streams without a native implementation
+            run the sync version in a thread """
+        from idlib.core import in_thread
+        return await in_thread(self.metadata)
+
     def metadata(self, mimetype_accept=None):
         """ stream metadata, hopefully as a header
 
@@ -611,20 +687,53 @@ class StreamUri(Stream):
     def id_bound_data(self):
         raise NotImplementedError
 
-    _dereference_cache = {}  # FIXME real caching please lru here probably?
+    # shared across all instances, bounded so that long running processes
+    # stay flat, the full chains are also on disk see _dereference_chain_records
+    _dereference_cache = LRUCache(
+        max_entries=int(auth.get('cache-dereference-max-entries')))
+    # when weak the chains are only shared while some stream still holds
+    # them so the responses they carry can be collected
+    _dereference_weak = str(auth.get('cache-dereference-weak')).lower() in (
+        'true', '1', 'yes')
+
+    @classmethod
+    def _dereference_cache_get(cls, key):
+        chain = StreamUri._dereference_cache.get(key)
+        if chain is None or not StreamUri._dereference_weak:
+            return chain
+
+        # None in a weak chain is a null pointer, not a dead reference
+        strong = tuple(ref if ref is None else ref() for ref in chain)
+        if any(ref is not None and p is None for ref, p in zip(chain, strong)):
+            StreamUri._dereference_cache.pop(key)
+            return
+
+        return strong
+
+    @classmethod
+    def _dereference_cache_put(cls, key, chain):
+        if StreamUri._dereference_weak:
+            value = tuple(p if p is None else weakref.ref(p) for p in chain)
+        else:
+            value = chain
+
+        StreamUri._dereference_cache.put(key, value)
+        return chain
+
     @cache_result  # this is only per instance not globally
     def dereference_chain(self):
         # FIXME this is really dereference chain super
-        dc = StreamUri._dereference_cache
-        if not self.identifier_actionable in dc:
+        key = self.identifier_actionable
+        chain = StreamUri._dereference_cache_get(key)
+        if chain is None:
             try:
-                dc[self.identifier_actionable] = tuple(
-                    resp if resp is None else StringProgenitor(resp.url, progenitor=resp)
-                    for resp in
-                    self._resolution_chain_responses(
-                        self.identifier_actionable,
-                        raise_on_final=False,
-                        headers_fun=self._resolution_chain_headers_fun))
+                records = self._dereference_chain_records(key)
+                if records is None:
+                    # transient failures are never shared
+                    chain = self._chain_transient_progenitors(key)
+                else:
+                    chain = StreamUri._dereference_cache_put(
+                        key, self._chain_progenitors(records))
             except (exc.ResolutionError, exc.RemoteError) as e:
                 # TODO
                 # FIXME partial resolution is a complete nightmare
@@ -635,7 +744,24 @@ class StreamUri(Stream):
                 # error
                 raise e
 
-        return dc[self.identifier_actionable]
+        return chain
+
+    async def adereference_chain(self):
+        cache_name = '_cache_dereference_chain'  # share with cache_result above
+        if hasattr(self, cache_name):
+            return getattr(self, cache_name)
+
+        key = self.identifier_actionable
+        out = StreamUri._dereference_cache_get(key)
+        if out is None:
+            records = await self._adereference_chain_records(key)
+            if records is None:
+                out = self._chain_transient_progenitors(key)
+            else:
+                out = StreamUri._dereference_cache_put(key, self._chain_progenitors(records))
+
+        setattr(self, cache_name, out)
+        return out
 
     @cache_result
     def dereference(self, asType=None):
@@ -690,17 +816,71 @@ class StreamUri(Stream):
         if uri is not None:
             return uri.progenitor().headers
 
-    def data(self, mimetype_accept=None):
+    def data(self, mimetype_accept=None, max_bytes=None):
         # FIXME TODO should the data associated with the doi
         # be the metadata about the object or the object itself?
         # from a practical standpoint derefercing the doi is
         # required before you can content negotiate on the
         # actual document itself, which is a practical necessity
         # if somewhat confusing
+        return b''.join(self.data_chunks(max_bytes=max_bytes))
+
+    def data_chunks(self, chunk_size=DATA_CHUNK_SIZE, max_bytes=None):
+        """ yield the data without ever holding all of it, raises
+            DataTooLargeError as soon as it is known to be over max_bytes """
         self._progenitors = {}
-        resp = self._requests.get(self.identifier)  # FIXME TODO explicit dereference
+        resp = self._requests.get(self.identifier, stream=True)  # FIXME TODO explicit dereference
         self._progenitors['stream-http'] = resp
-        return resp.content
+        try:
+            length = resp.headers.get('Content-Length')
+            if max_bytes is not None and length is not None and int(length) > max_bytes:
+                msg = f'{self.identifier} is {length} bytes, more than {max_bytes}'
+                raise exc.DataTooLargeError(msg)
+
+            size = 0
+            for chunk in resp.iter_content(chunk_size):
+                size += len(chunk)
+                if max_bytes is not None and size > max_bytes:
+                    msg = f'{self.identifier} is more than {max_bytes} bytes'
+                    raise exc.DataTooLargeError(msg)
+
+                yield chunk
+        finally:
+            resp.close()
+
+    def data_file(self, max_bytes=None, cache=False):
+        """ the data as a file like object positioned at the start,
+            kept in memory up to DATA_SPOOL_BYTES and spooled to a
+            temporary file past that, with cache=True the data is stored
+            once by content under cache-path/data and later calls return
+            a read only mmap of it without downloading again """
+        if cache:
+            blob = self._data_blob(self.identifier_actionable, max_bytes)
+            try:
+                return StreamUri._data_blobs.open(blob['digest'])
+            except FileNotFoundError:
+                # the blob was removed under the index entry
+                blob = self._data_blob(self.identifier_actionable, max_bytes,
+                                       _refresh_cache=True)
+                return StreamUri._data_blobs.open(blob['digest'])
+
+        f = tempfile.SpooledTemporaryFile(max_size=DATA_SPOOL_BYTES)
+        for chunk in self.data_chunks(max_bytes=max_bytes):
+            f.write(chunk)
+
+        f.seek(0)
+        return f
+
+    _data_blobs = BlobStore(auth.get_path('cache-path') / 'data')
+
+    # the index from iri to digest is a normal cache entry so it gets
+    # ttl and eviction, the bodies themselves live in _data_blobs
+    @cache(auth.get_path('cache-path') / 'data_index', create=True,
+           ttl=auth.get('cache-data-ttl'))
+    def _data_blob(self, iri, max_bytes):
+        digest, size = StreamUri._data_blobs.put_chunks(
+            self.data_chunks(max_bytes=max_bytes))
+        return {'digest': digest, 'size': size}
 
     def asUri(self, asType=None):
         # FIXME this should probably be abstracted to asActionable
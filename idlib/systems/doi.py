@@ -4,8 +4,10 @@ from idlib import formats
 from idlib import streams
 from idlib import exceptions as exc
 from idlib import conventions as conv
-from idlib.cache import cache
-from idlib.utils import cache_result, log
+from idlib.cache import (cache, conditional_headers, record_validators, fingerprint,
+                         NOT_MODIFIED)
+from idlib.core import in_thread
+from idlib.utils import cache_result, log, resp_json
 from idlib.config import auth
 
 
@@ -72,6 +74,10 @@ class DoiId(oq.OntId, idlib.Identifier, idlib.Stream):  # also _technically_ a s
     def valid(self):
         return self.suffix is not None and self.suffix.startswith('10.')
 
+    def asCacheKey(self):
+        # dois are case insensitive, lower is what crossref uses
+        return str(self).lower()
+
     def validate(self):
         if not self.valid:
             raise exc.MalformedIdentifierError(f'{self._unnormalized} does not appear '
@@ -89,10 +95,14 @@ class Doi(formats.Rdf, idlib.Stream):  # FIXME that 'has canonical representaito
 
     identifier_actionable = streams.StreamUri.identifier_actionable
     dereference_chain = streams.StreamUri.dereference_chain
+    adereference_chain = streams.StreamUri.adereference_chain
     dereference = streams.StreamUri.dereference
     progenitor = streams.StreamUri.progenitor
     headers = streams.StreamUri.headers
     data = streams.StreamUri.data
+    data_chunks = streams.StreamUri.data_chunks
+    data_file = streams.StreamUri.data_file
+    _data_blob = streams.StreamUri._data_blob
 
     def __init__(self, doi_in_various_states_of_mangling=None, iri=None):
         self._identifier = self._id_class(doi_in_various_states_of_mangling, iri)
@@ -146,21 +156,53 @@ class Doi(formats.Rdf, idlib.Stream):  # FIXME that 'has canonical representaito
         self._path_metadata = path
         return metadata
 
-    @cache(auth.get_path('cache-path') / 'doi_json', create=True, return_path=True)
+    async def ametadata(self):
+        if hasattr(self, '_cache_metadata'):  # shared with cache_result
+            return self._cache_metadata
+
+        metadata, path = await self._ametadata(self.identifier)
+        self._path_metadata = path
+        self._cache_metadata = metadata
+        return metadata
+
+    # e.g. crossref, datacite, etc.
+    # so this stuff isnt quite to the spec that is doccumented here
+    # https://crosscite.org/docs.html
+    # nor here
+    # https://support.datacite.org/docs/datacite-content-resolver
+    _metadata_accept = (
+        'application/vnd.datacite.datacite+json, '  # first so it can fail
+        'application/json, '  # undocumented fallthrough for crossref ?
+    )
+
+    def _metadata_headers(self):
+        return {'Accept': self._metadata_accept, **conditional_headers()}
+
+    # changing _metadata_accept changes the version so stale entries are ignored
+    # root_version is the fingerprint of the accept header from before versioning
+    @cache(auth.get_path('cache-path') / 'doi_json', create=True, return_path=True,
+           validators=True, version=fingerprint(_metadata_accept),
+           root_version='ff6a6cb86ab11942')
     def _metadata(self, identifier):
-        # e.g. crossref, datacite, etc.
-        # so this stuff isnt quite to the spec that is doccumented here
-        # https://crosscite.org/docs.html
-        # nor here
-        # https://support.datacite.org/docs/datacite-content-resolver
-        accept = (
-            'application/vnd.datacite.datacite+json, '  # first so it can fail
-            'application/json, '  # undocumented fallthrough for crossref ?
-        )
-        resp = self._requests.get(identifier, headers={'Accept': accept})
+        resp = self._requests.get(identifier, headers=self._metadata_headers())
+        return self._metadata_response(resp, identifier)
+
+    @_metadata.coroutine
+    async def _ametadata(self, identifier):
+        resp = await self._arequests.get(identifier, headers=self._metadata_headers())
+        if resp.status_code >= 400 and resp.status_code != 404:
+            # the datacite and crossref fallbacks are rare so stay sync
+            return await in_thread(self._metadata_response, resp, identifier)
+
+        return self._metadata_response(resp, identifier)
+
+    def _metadata_response(self, resp, identifier):
         self._resp_metadata = resp  # FIXME for progenitor
-        if resp.ok:
-            return resp.json()
+        if resp.status_code == 304:  # 304 is ok so check it first
+            return NOT_MODIFIED
+        elif resp.ok:
+            record_validators(resp)
+            return resp_json(resp)
         else:
             try:
                 self._resp_metadata.raise_for_status()
@@ -189,7 +231,7 @@ class Doi(formats.Rdf, idlib.Stream):  # FIXME that 'has canonical representaito
         resp = self._requests.get(crossref_api, headers={'Accept': accept})
         self._resp_metadata = resp  # FIXME for progenitor
         if resp.ok:
-            j = resp.json()
+            j = resp_json(resp)
             return j['message']
         else:
             try:
@@ -210,7 +252,7 @@ class Doi(formats.Rdf, idlib.Stream):  # FIXME that 'has canonical representaito
         resp = self._requests.get(datacite_api, headers={'Accept': accept})
         self._resp_metadata = resp  # FIXME for progenitor
         if resp.ok:
-            return resp.json()
+            return resp_json(resp)
         else:
             try:
                 self._resp_metadata.raise_for_status()
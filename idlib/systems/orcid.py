@@ -5,8 +5,9 @@ import idlib
 from idlib import streams
 from idlib import exceptions as exc
 from idlib import conventions as conv
-from idlib.cache import cache
-from idlib.utils import cache_result, log
+from idlib.cache import (cache, conditional_headers, record_validators, fingerprint,
+                         NOT_MODIFIED)
+from idlib.utils import cache_result, log, resp_json
 from idlib.config import auth
 
 
@@ -121,6 +122,7 @@ class Orcid(idlib.HelperNoData, idlib.Stream):
 
     identifier_actionable = streams.StreamUri.identifier_actionable
     dereference_chain = streams.StreamUri.dereference_chain
+    adereference_chain = streams.StreamUri.adereference_chain
     dereference = streams.StreamUri.dereference
     #progenitor = streams.StreamUri.progenitor
     headers = streams.StreamUri.headers
@@ -133,16 +135,44 @@ class Orcid(idlib.HelperNoData, idlib.Stream):
         self._path_metadata = path
         return metadata
 
-    @cache(auth.get_path('cache-path') / 'orcid_json', create=True, return_path=True)
-    def _metadata(self, suffix):
+    async def ametadata(self):
+        if hasattr(self, '_cache_metadata'):  # shared with cache_result
+            return self._cache_metadata
+
+        metadata, path = await self._ametadata(self.identifier.suffix)
+        self._path_metadata = path
+        self._cache_metadata = metadata
+        return metadata
+
+    _metadata_accept = 'application/orcid+json'
+
+    def _metadata_uri(self, suffix):
         # TODO data endpoint prefix ??
         # vs data endpoint pattern ...
         prefix = 'orcid.pub.3'  # NOTE THE CHANGE IN PREFIX
-        idq = self._id_class(prefix=prefix, suffix=suffix)
-        headers = {'Accept': 'application/orcid+json'}
-        self._resp_metadata = self._requests.get(idq, headers=headers)
-        if self._resp_metadata.ok:
-            return self._resp_metadata.json()
+        return self._id_class(prefix=prefix, suffix=suffix)
+
+    @cache(auth.get_path('cache-path') / 'orcid_json', create=True, return_path=True,
+           validators=True, version=fingerprint(_metadata_accept),
+           root_version='89f44895fb9b8371')
+    def _metadata(self, suffix):
+        headers = {'Accept': self._metadata_accept, **conditional_headers()}
+        self._resp_metadata = self._requests.get(self._metadata_uri(suffix), headers=headers)
+        return self._metadata_response()
+
+    @_metadata.coroutine
+    async def _ametadata(self, suffix):
+        headers = {'Accept': self._metadata_accept, **conditional_headers()}
+        self._resp_metadata = await self._arequests.get(self._metadata_uri(suffix),
+                                                        headers=headers)
+        return self._metadata_response()
+
+    def _metadata_response(self):
+        if self._resp_metadata.status_code == 304:  # 304 is ok so check it first
+            return NOT_MODIFIED
+        elif self._resp_metadata.ok:
+            record_validators(self._resp_metadata)
+            return resp_json(self._resp_metadata)
 
     @property
     def id_bound_metadata(self):  # FIXME bound_id_metadata bound_id_data
@@ -6,8 +6,8 @@ from idlib import formats
 from idlib import streams
 from idlib import exceptions as exc
 from idlib import conventions as conv
-from idlib.cache import cache
-from idlib.utils import cache_result, log, base32_crockford_decode
+from idlib.cache import cache, conditional_headers, record_validators, NOT_MODIFIED
+from idlib.utils import cache_result, log, resp_json, base32_crockford_decode
 from idlib.config import auth
 
 
@@ -68,6 +68,7 @@ class Ror(formats.Rdf, idlib.HelperNoData, idlib.Stream):
 
     identifier_actionable = streams.StreamUri.identifier_actionable
     dereference_chain = streams.StreamUri.dereference_chain
+    adereference_chain = streams.StreamUri.adereference_chain
     dereference = streams.StreamUri.dereference
     #progenitor = streams.StreamUri.progenitor
     headers = streams.StreamUri.headers
@@ -111,15 +112,40 @@ class Ror(formats.Rdf, idlib.HelperNoData, idlib.Stream):
         self._path_metadata = path
         return metadata
 
-    @cache(auth.get_path('cache-path') / 'ror_json', create=True, return_path=True)
-    def _metadata(self, suffix):
+    async def ametadata(self):
+        if hasattr(self, '_cache_metadata'):  # shared with cache_result
+            return self._cache_metadata
+
+        metadata, path = await self._ametadata(self.identifier.suffix)
+        self._path_metadata = path
+        self._cache_metadata = metadata
+        return metadata
+
+    def _metadata_uri(self, suffix):
         # TODO data endpoint prefix ??
         # vs data endpoint pattern ...
         prefix = 'ror.api'  # NOTE THE CHANGE IN PREFIX
-        idq = self._id_class(prefix=prefix, suffix=suffix)
-        self._resp_metadata = self._requests.get(idq)
-        if self._resp_metadata.ok:
-            blob = self._resp_metadata.json()
+        return self._id_class(prefix=prefix, suffix=suffix)
+
+    @cache(auth.get_path('cache-path') / 'ror_json', create=True, return_path=True,
+           validators=True)
+    def _metadata(self, suffix):
+        idq = self._metadata_uri(suffix)
+        self._resp_metadata = self._requests.get(idq, headers=conditional_headers())
+        return self._metadata_response()
+
+    @_metadata.coroutine
+    async def _ametadata(self, suffix):
+        idq = self._metadata_uri(suffix)
+        self._resp_metadata = await self._arequests.get(idq, headers=conditional_headers())
+        return self._metadata_response()
+
+    def _metadata_response(self):
+        if self._resp_metadata.status_code == 304:  # 304 is ok so check it first
+            return NOT_MODIFIED
+        elif self._resp_metadata.ok:
+            record_validators(self._resp_metadata)
+            blob = resp_json(self._resp_metadata)
             if len(blob) == 1 and 'errors' in blob:
                 errors = blob['errors']
                 if len(errors) == 1:
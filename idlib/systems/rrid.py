@@ -1,12 +1,11 @@
 import re
-from time import sleep
 import idlib
 from idlib import formats
 from idlib import streams
 from idlib import exceptions as exc
 from idlib import conventions as conv
 from idlib.cache import cache, COOLDOWN
-from idlib.utils import cache_result, log
+from idlib.utils import cache_result, log, resp_json
 from idlib.config import auth
 
 
@@ -51,6 +50,7 @@ class Rrid(formats.Rdf, idlib.HelperNoData, idlib.Stream):
 
     identifier_actionable = streams.StreamUri.identifier_actionable
     dereference_chain = streams.StreamUri.dereference_chain
+    adereference_chain = streams.StreamUri.adereference_chain
     dereference = streams.StreamUri.dereference
     headers = streams.StreamUri.headers
 
@@ -77,6 +77,17 @@ class Rrid(formats.Rdf, idlib.HelperNoData, idlib.Stream):
     @cache_result
     def metadata(self):
         metadata, path = self._metadata(self.identifier)
+        return self._metadata_source(metadata, path)
+
+    async def ametadata(self):
+        if hasattr(self, '_cache_metadata'):  # shared with cache_result
+            return self._cache_metadata
+
+        metadata, path = await self._ametadata(self.identifier)
+        self._cache_metadata = self._metadata_source(metadata, path)
+        return self._cache_metadata
+
+    def _metadata_source(self, metadata, path):
         # oh look an immediate violation of the URI assumption ...
         if metadata is not None:
             self._path_metadata = path
@@ -92,37 +103,31 @@ class Rrid(formats.Rdf, idlib.HelperNoData, idlib.Stream):
         metadata, path = self._metadata(self.identifier)
         return metadata
 
-    @cache(auth.get_path('cache-path') / 'rrid_json', create=True, return_path=True)
-    def _metadata(self, identifier):
+    def _metadata_uri(self, identifier):
         idq = self._resolver_template.format(id=identifier)
         #self._resp_metadata = self._requests.get(idq, headers={'Accept': 'application/json'})  # issue submitted
-        self._resp_metadata = self._requests.get(idq + '.json')
+        return idq + '.json'
+
+    # 429s are retried by the rate limiter in the session so anything
+    # that makes it here has been waited on as long as we are willing to
+    @cache(auth.get_path('cache-path') / 'rrid_json', create=True, return_path=True,
+           compress=auth.get('cache-compress'))
+    def _metadata(self, identifier):
+        self._resp_metadata = self._requests.get(self._metadata_uri(identifier))
+        return self._metadata_response(identifier)
+
+    @_metadata.coroutine
+    async def _ametadata(self, identifier):
+        self._resp_metadata = await self._arequests.get(self._metadata_uri(identifier))
+        return self._metadata_response(identifier)
+
+    def _metadata_response(self, identifier):
         if self._resp_metadata.ok:
-            return self._resp_metadata.json()
+            return resp_json(self._resp_metadata)
         elif self._COOLDOWN and self._resp_metadata.status_code == 404:
             msg = f'RRID failure: {self._resp_metadata.status_code} {self.asUri()}'
-            return {COOLDOWN: msg,}
-        elif self._resp_metadata.status_code == 429:
-            headers = self._resp_metadata.headers
-            if 'Retry-After' in headers:
-                try:
-                    wait = int(headers['Retry-After'])
-                except ValueError as ve:
-                    try:
-                        self._resp_metadata.raise_for_status()
-                    except Exception as e:
-                        raise exc.ResolutionError(identifier) from e
-
-                if wait > 20:
-                    try:
-                        self._resp_metadata.raise_for_status()
-                    except Exception as e:
-                        raise exc.ResolutionError(identifier) from e
-
-                log.debug(f'waiting {wait}s for {identifier}')
-                sleep(wait)
-                return self._metadata(identifier)
-
+            return {COOLDOWN: msg,
+                    'http_status_code': self._resp_metadata.status_code,}
         else:
             try:
                 self._resp_metadata.raise_for_status()
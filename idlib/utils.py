@@ -1,9 +1,19 @@
 import os
 import logging
+import threading
+import contextvars
+from time import monotonic
 from datetime import datetime, timezone
 from functools import wraps
+from contextlib import contextmanager
+from collections import OrderedDict
 from idlib import exceptions as exc
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 ## logging
 
@@ -56,6 +66,71 @@ class StringProgenitor(str):
         return (str(self),), dict(progenitor=self._progenitor)
 
 
+class Deadline:
+    """ a point in time after which remote calls give up, it never
+        changes once made so it is safe to share between threads and
+        tasks, see deadline to apply one to every http request """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.at = monotonic() + seconds
+
+    def remaining(self):
+        return self.at - monotonic()
+
+    @property
+    def expired(self):
+        return self.remaining() <= 0
+
+    def check(self, what=''):
+        if self.expired:
+            msg = f'deadline of {self.seconds}s exceeded {what}'.strip()
+            raise exc.DeadlineExceededError(msg)
+
+    def cap(self, timeout, what=''):
+        """ limit timeout, None, seconds, or (connect, read), to what is left """
+        self.check(what)
+        remaining = self.remaining()
+        if isinstance(timeout, tuple):
+            return tuple(remaining if t is None else min(t, remaining) for t in timeout)
+
+        return remaining if timeout is None else min(timeout, remaining)
+
+
+_deadline = contextvars.ContextVar('idlib_deadline', default=None)
+
+
+def current_deadline():
+    return _deadline.get()
+
+
+@contextmanager
+def deadline(seconds):
+    """ every http request made inside this block by this thread or
+        task is cut off when seconds, or a Deadline, runs out, nested
+        deadlines can only shorten the outer one, None changes nothing
+
+        with deadline(10):
+            doi.metadata()
+
+        contextvars follow asyncio tasks and idlib.core.in_thread,
+        plain threads start with no deadline """
+    outer = _deadline.get()
+    if seconds is None:
+        yield outer
+        return
+
+    new = seconds if isinstance(seconds, Deadline) else Deadline(seconds)
+    if outer is not None and outer.at < new.at:
+        new = outer
+
+    token = _deadline.set(new)
+    try:
+        yield new
+    finally:
+        _deadline.reset(token)
+
+
 def timeout(duration, *, error=None):
     import signal
     class InternalTimeoutError(TimeoutError): pass
@@ -64,7 +139,21 @@ def timeout(duration, *, error=None):
     def _timeout(f):
         @wraps(f)
         def inner(*args, **kwargs):
-            previous_handler = signal.getsignal(signal.SIGABRT)
+            if threading.current_thread() is not threading.main_thread():
+                # signals only work in the main thread, fall back to a
+                # deadline which covers the http requests made by f
+                try:
+                    with deadline(duration):
+                        return f(*args, **kwargs)
+                except exc.DeadlineExceededError as e:
+                    if error is not None:
+                        msg = f'function timed out {f}'
+                        raise error(msg) from e
+                    else:
+                        log.error(e)
+                        return
+
+            previous_handler = signal.getsignal(signal.SIGALRM)
             signal.signal(signal.SIGALRM, _alrm)
             signal.alarm(duration)
             try:
@@ -89,6 +178,19 @@ if os.name == 'nt':
         return f
 
 
+def resp_json(resp):
+    """ decode the json body of a response, faster than resp.json()
+        when orjson is installed, falls back to resp.json() otherwise
+        and for anything orjson rejects e.g. non utf-8 bodies """
+    if orjson is not None:
+        try:
+            return orjson.loads(resp.content)
+        except orjson.JSONDecodeError:
+            pass
+
+    return resp.json()
+
+
 def cache_result(method):
     """ if the method has run, stash the value for when the method is called again
     WITH NO ARGUMENTS (or at some point the same arguments), last one wins I think
@@ -108,6 +210,89 @@ def cache_result(method):
     return inner
 
 
+class LRUCache:
+    """ thread safe least recently used mapping bounded by the number
+        of entries and by the approximate size in bytes of the entries
+        as reported by the caller, None means unbounded """
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, size = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, size=0):
+        if self.max_bytes is not None and size > self.max_bytes:
+            # never evict everything else for one giant entry
+            self.pop(key)
+            return
+
+        with self._lock:
+            if key in self._data:
+                self.nbytes -= self._data.pop(key)[1]
+
+            self._data[key] = value, size
+            self.nbytes += size
+            self._evict()
+
+    def pop(self, key, default=None):
+        with self._lock:
+            try:
+                value, size = self._data.pop(key)
+            except KeyError:
+                return default
+
+            self.nbytes -= size
+            return value
+
+    def resize(self, max_entries=None, max_bytes=None):
+        with self._lock:
+            self.max_entries = max_entries
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+    def _evict(self):
+        while self._data and (
+                self.max_entries is not None and len(self._data) > self.max_entries or
+                self.max_bytes is not None and self.nbytes > self.max_bytes):
+            _, (_, size) = self._data.popitem(last=False)
+            self.nbytes -= size
+
+    def stats(self):
+        return {'entries': len(self._data),
+                'bytes': self.nbytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,}
+
+
 def makeEnc(alphabet):
     index = {c:i for i, c in enumerate(alphabet)}
     iindex = {v:k for k, v in index.items()}
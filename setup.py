@@ -21,6 +21,9 @@ with open('README.md', 'rt') as f:
 org_require = ['beautifulsoup4[html5lib]']
 rdf_require = ['pyontutils>=0.1.28']
 oauth_require = ['google-auth-oauthlib']
+zstd_require = ['zstandard']
+fast_require = ['orjson', 'msgpack']
+async_require = ['httpx']
 tests_require = (['pytest', 'joblib>=1.1.0'] +
                  org_require +
                  rdf_require +
@@ -64,7 +67,13 @@ setup(name='idlib',
                       'org': org_require,
                       'rdf': rdf_require,
                       'oauth': oauth_require,
+                      'zstd': zstd_require,
+                      'fast': fast_require,
+                      'async': async_require,
                      },
       scripts=[],
-      entry_points={'console_scripts': [ ],},
+      entry_points={'console_scripts': [
+          'idlib-cache=idlib.cache:main',
+          'idlib-mock=idlib.mock:main',
+      ],},
      )
@@ -1,7 +1,23 @@
+import json
 import unittest
 from idlib.cache import cache_hash, argspector
 
 
+class TempFolderTestCase(unittest.TestCase):
+    """ self.folder is a cache namespace folder that does not exist yet
+        under self.tmp, a temporary directory removed after each test """
+
+    def setUp(self):
+        import tempfile
+        from pathlib import Path
+        self._tempdir = tempfile.TemporaryDirectory()
+        self.tmp = Path(self._tempdir.name)
+        self.folder = self.tmp / 'ns'
+
+    def tearDown(self):
+        self._tempdir.cleanup()
+
+
 class TestCacheHash(unittest.TestCase):
     def test_argspector(self):
         class c:
@@ -33,3 +49,516 @@ class TestCacheHash(unittest.TestCase):
             for args, kwargs in arg_sets:
                 pairs = list(spector(*args, **kwargs))
                 cache_hash(pairs)
+
+
+class TestCacheBackends(TempFolderTestCase):
+    backend = 'file'
+
+    def test_roundtrip(self):
+        from idlib.cache import cache
+        calls = []
+
+        @cache(self.folder, create=True, return_path=True, backend=self.backend)
+        def f(value):
+            calls.append(value)
+            return {'value': value}
+
+        out, path = f('a')
+        assert out == {'value': 'a'}
+        assert path.exists()
+        out, path = f('a')
+        assert out == {'value': 'a'}
+        assert calls == ['a'], calls
+        f('a', _refresh_cache=True)
+        assert calls == ['a', 'a'], calls
+
+    def test_cooldown(self):
+        from idlib.cache import cache, read_entry, COOLDOWN
+        calls = []
+
+        @cache(self.folder, create=True, return_path=True, backend=self.backend)
+        def f(value):
+            calls.append(value)
+            return {COOLDOWN: 'nope', 'status': 404}
+
+        out, path = f('a')
+        assert out is None
+        out, path = f('a')
+        assert out is None
+        assert calls == ['a'], calls
+        assert read_entry(path)['status'] == 404
+
+    def test_cooldown_expires(self):
+        from time import sleep
+        from idlib.cache import cache, cooldown_policy, COOLDOWN
+        calls = []
+        policy = cooldown_policy({404: None, 429: 0.1})
+
+        @cache(self.folder, create=True, backend=self.backend, cooldown=policy)
+        def f(value):
+            calls.append(value)
+            return {COOLDOWN: 'nope', 'http_status_code': value}
+
+        assert f(404) is None
+        assert f(429) is None
+        sleep(0.2)
+        assert f(404) is None
+        assert f(429) is None
+        assert calls == [404, 429, 429], calls
+
+    def test_memory(self):
+        from idlib.cache import cache, memory
+        calls = []
+
+        @cache(self.folder, create=True, backend=self.backend)
+        def f(value):
+            calls.append(value)
+            return {'value': value}
+
+        f('a')['value'] = 'mutated'  # callers own what they get back
+        hits = memory.hits
+        assert f('a') == {'value': 'a'}
+        assert memory.hits == hits + 1
+        assert calls == ['a'], calls
+        f('a')['value'] = 'mutated'
+        assert f('a') == {'value': 'a'}
+
+        # memory hits do not go to the disk even for the path
+        @cache(self.folder, backend=self.backend, return_path=True)
+        def g(value):
+            return {'value': value}
+
+        _, path = g('b')
+        paths = []
+        g.cache_store.path = lambda key: paths.append(key)
+        out, mpath = g('b')
+        assert out == {'value': 'b'} and str(mpath) == str(path)
+        assert paths == [], paths
+
+    def test_compress(self):
+        from idlib.cache import cache, zstandard, train_zstd_dictionary
+        def f(value):
+            return {'value': value, 'pad': 'hello world ' * (value + 10)}
+
+        plain = cache(self.folder, create=True, backend=self.backend, memory=False)(f)
+        gz = cache(self.folder, backend=self.backend, memory=False, compress='gzip')(f)
+        # old uncompressed entries and new compressed entries both read
+        assert plain(1) == f(1)
+        assert gz(1) == f(1)
+        assert gz(2, _refresh_cache=True) == f(2)
+        assert plain(2) == f(2)
+        if zstandard is not None:
+            for i in range(200):
+                plain(i)
+
+            train_zstd_dictionary(self.folder, backend=self.backend, dict_size=4096)
+            zs = cache(self.folder, backend=self.backend, memory=False, compress='zstd')(f)
+            assert zs(3, _refresh_cache=True) == f(3)
+            assert plain(3) == f(3)
+            assert gz(3) == f(3)
+
+    def test_compress_dict_later(self):
+        from idlib.cache import cache, zstandard, train_zstd_dictionary, _zstd_dicts, ZSTD_DICTS
+        if zstandard is None:
+            self.skipTest('zstandard is not installed')
+
+        calls = []
+        def f(value):
+            calls.append(value)
+            return {'value': value, 'pad': 'hello world ' * (value + 10)}
+
+        # the reader exists before any dictionary does
+        reader = cache(self.folder, create=True, backend=self.backend, memory=False)(f)
+        for i in range(200):
+            reader(i)
+
+        # as if another process trained a dictionary and wrote with it
+        zdict = train_zstd_dictionary(self.folder, backend=self.backend, dict_size=4096)
+        zs = cache(self.folder, backend=self.backend, memory=False, compress='zstd')(f)
+        expect = zs(3, _refresh_cache=True)
+        _zstd_dicts.pop(zdict.dict_id())
+        calls.clear()
+        assert reader(3) == expect
+        assert calls == [], calls
+
+        # an entry whose dictionary is gone is a miss not an error
+        zs(3, _refresh_cache=True)
+        _zstd_dicts.pop(zdict.dict_id())
+        (self.folder / ZSTD_DICTS / str(zdict.dict_id())).unlink()
+        calls.clear()
+        assert reader(3) == expect
+        assert calls == [3], calls
+
+    def test_ser(self):
+        from idlib.cache import cache
+        def f(value):
+            return {'value': value, 'list': [1, 2.5, None, True]}
+
+        json_ = cache(self.folder, create=True, backend=self.backend, memory=False)(f)
+        for ser in ('orjson', 'msgpack'):
+            fast = cache(self.folder, backend=self.backend, memory=False, ser=ser)(f)
+            assert json_(ser) == f(ser)
+            assert fast(ser) == f(ser)  # read what json wrote
+            assert fast(ser, _refresh_cache=True) == f(ser)
+            assert fast(ser) == f(ser)
+
+    def test_single_flight(self):
+        from time import sleep
+        from concurrent.futures import ThreadPoolExecutor
+        from idlib.cache import cache
+        calls = []
+
+        @cache(self.folder, create=True, backend=self.backend)
+        def f(value):
+            calls.append(value)
+            sleep(0.2)
+            return {'value': value}
+
+        with ThreadPoolExecutor(4) as pool:
+            outs = list(pool.map(f, ['a'] * 4))
+
+        assert outs == [{'value': 'a'}] * 4, outs
+        assert calls == ['a'], calls
+        assert not [p for p in self.folder.iterdir() if p.name.endswith('.tmp')]
+
+    def test_validators(self):
+        from idlib.cache import (cache, read_entry, conditional_headers,
+                                 record_validators, NOT_MODIFIED)
+        class resp:
+            headers = {'ETag': '"v1"', 'Last-Modified': 'Mon, 01 Jan 2024 00:00:00 GMT'}
+
+        sent = []
+
+        @cache(self.folder, create=True, return_path=True, backend=self.backend,
+               validators=True)
+        def f(value):
+            headers = conditional_headers()
+            sent.append(headers)
+            if headers.get('If-None-Match') == '"v1"':
+                return NOT_MODIFIED
+
+            record_validators(resp)
+            return {'value': value}
+
+        out, path = f('a')
+        assert out == {'value': 'a'}, out
+        assert sent == [{}], sent
+        out, path = f('a', _refresh_cache=True)
+        assert out == {'value': 'a'}, out
+        assert sent[-1] == {'If-None-Match': '"v1"',
+                            'If-Modified-Since': 'Mon, 01 Jan 2024 00:00:00 GMT'}, sent
+        assert read_entry(path) == {'value': 'a'}
+        assert f('a')[0] == {'value': 'a'}
+        assert len(sent) == 2, sent
+
+    def test_evict(self):
+        from idlib.cache import cache, evict, gc
+        @cache(self.folder, create=True, backend=self.backend, memory=False,
+               max_bytes=10 ** 6)
+        def f(value):
+            return {'value': value, 'pad': 'x' * 100}
+
+        for v in range(20):
+            f(v)
+
+        store = f.cache_store
+        size = sum(u.size for u in store.usage())
+        assert len(list(store.keys())) == 20
+        f(0)  # keep 0 warm, max_bytes means reads are tracked
+        count, freed = evict(store, size // 2, 'lru')
+        assert count >= 10, count
+        assert f.cache_key(0) in set(store.keys())
+        assert sum(u.size for u in store.usage()) <= size // 2
+        count, freed = gc(self.folder.parent, max_bytes_total=0)
+        assert not list(store.keys())
+
+    def test_evict_threads(self):
+        import threading
+        from time import sleep
+        from concurrent.futures import ThreadPoolExecutor
+        from idlib import cache as cmod
+        running, seen, lock = [0], [], threading.Lock()
+        def evict(store, max_bytes, eviction):
+            with lock:
+                running[0] += 1
+                seen.append(running[0])
+
+            sleep(0.05)
+            with lock:
+                running[0] -= 1
+
+        def f(value):
+            return {'value': value}
+
+        # two decorators on one folder share the eviction lock
+        fs = [cmod.cache(self.folder, create=True, backend=self.backend, memory=False,
+                         max_bytes=10 ** 9)(f) for _ in range(2)]
+        old = cmod.evict, cmod.EVICT_EVERY
+        cmod.evict, cmod.EVICT_EVERY = evict, 10
+        try:
+            with ThreadPoolExecutor(8) as pool:
+                list(pool.map(lambda v: fs[v % 2](v), range(400)))
+
+            sleep(0.1)
+        finally:
+            cmod.evict, cmod.EVICT_EVERY = old
+
+        assert seen and max(seen) == 1, seen
+
+    def test_stats(self):
+        from idlib.cache import cache, cache_stats, dump_cache_stats, COOLDOWN
+        @cache(self.folder, create=True, backend=self.backend)
+        def f(value):
+            if value == 'bad':
+                return {COOLDOWN: 'nope', 'http_status_code': 404}
+
+            return {'value': value}
+
+        f('a'), f('a'), f('bad'), f('bad')
+        # a second decorator on the same folder shares the stats
+        g = cache(self.folder, backend=self.backend, memory=False)(f.__wrapped__)
+        g('a')
+        stats = cache_stats(self.folder)
+        assert stats['misses'] == 2, stats
+        assert stats['memory_hits'] == 1, stats
+        assert stats['hits'] == 2, stats  # g('a') and the cooldown for 'bad'
+        assert stats['cooldown_hits'] == 1, stats
+        assert stats['bytes_written'] > 0 and stats['bytes_read'] > 0, stats
+        assert stats['latency']['miss']['count'] == 2, stats
+        path = self.folder.parent / 'stats.json'
+        dump_cache_stats(path)
+        assert str(self.folder) in json.loads(path.read_text())['namespaces']
+
+    def test_coroutine(self):
+        import asyncio
+        from idlib.cache import cache, COOLDOWN
+        calls = []
+
+        @cache(self.folder, create=True, backend=self.backend, memory=False)
+        def f(value):
+            calls.append(('sync', value))
+            return {'value': value}
+
+        @f.coroutine
+        async def af(value):
+            calls.append(('async', value))
+            await asyncio.sleep(0.05)
+            if value == 'bad':
+                return {COOLDOWN: 'nope', 'http_status_code': 404}
+
+            return {'value': value}
+
+        async def main():
+            return await asyncio.gather(*[af(v) for v in ['a', 'a', 'b', 'bad']])
+
+        outs = asyncio.run(main())
+        assert outs == [{'value': 'a'}, {'value': 'a'}, {'value': 'b'}, None], outs
+        assert sorted(calls) == [('async', 'a'), ('async', 'b'), ('async', 'bad')], calls
+        assert f('a') == {'value': 'a'} and f('bad') is None
+        assert len(calls) == 3, calls
+
+    def test_ttl(self):
+        from time import sleep
+        from idlib.cache import cache
+        calls = []
+
+        @cache(self.folder, create=True, backend=self.backend, ttl=0.2)
+        def f(value):
+            calls.append(value)
+            return {'value': value}
+
+        f('a'), f('a')
+        assert calls == ['a'], calls
+        sleep(0.3)
+        f('a')
+        assert calls == ['a', 'a'], calls
+
+
+class TestCacheBackendSqlite(TestCacheBackends):
+    backend = 'sqlite'
+
+
+class TestCacheLayout(TempFolderTestCase):
+    def test_migrate(self):
+        from idlib.cache import cache, migrate_layout
+        calls = []
+        def f(value):
+            calls.append(value)
+            return {'value': value}
+
+        flat = cache(self.folder, create=True, backend='file', layout='flat', memory=False,
+                     return_path=True)(f)
+        sharded = cache(self.folder, backend='file', layout='sharded', memory=False,
+                        return_path=True)(f)
+        values = list(range(50))
+        for v in values:
+            _, path = flat(v)
+            assert path.parent == self.folder
+
+        assert migrate_layout(self.folder, 'sharded', workers=4) == len(values)
+        for v in values:
+            out, path = sharded(v)
+            assert out == {'value': v}
+            assert path.parent.parent.parent == self.folder
+            # flat readers still find entries while a migration runs
+            assert flat(v)[0] == {'value': v}
+
+        assert calls == values
+        assert migrate_layout(self.folder, 'flat', workers=4) == len(values)
+        assert not [p for p in self.folder.iterdir() if p.is_dir() and p.name != '.locks']
+
+
+class TestCachePack(TempFolderTestCase):
+    def setUp(self):
+        super().setUp()
+        self.worker = self.tmp / 'worker'
+
+    def test_pack(self):
+        import shutil
+        from idlib.cache import cache, build_pack, read_entry, COOLDOWN
+        calls = []
+        def f(value):
+            calls.append(value)
+            if value == 'bad':
+                return {COOLDOWN: 'nope', 'http_status_code': 404}
+
+            return {'value': value}
+
+        warm = cache(self.folder, create=True, memory=False, compress='gzip')(f)
+        values = list(range(100)) + ['bad']
+        for v in values:
+            warm(v)
+
+        pack = build_pack(self.folder)
+        self.worker.mkdir()
+        shutil.copy(pack, self.worker)
+        cold = cache(self.worker, memory=False, return_path=True)(f)
+        calls.clear()
+        for v in values:
+            out, path = cold(v)
+            assert out == (None if v == 'bad' else {'value': v}), (v, out)
+
+        assert calls == [], calls
+        assert read_entry(path)[COOLDOWN] == 'nope'
+        # writes go to the folder and shadow the pack
+        out, path = cold(0, _refresh_cache=True)
+        assert calls == [0], calls
+        assert path.parent == self.worker and path.exists()
+        assert cold(1000)[0] == {'value': 1000}
+
+
+    def test_pack_zstd_dict(self):
+        import shutil
+        from idlib.cache import cache, build_pack, train_zstd_dictionary, zstandard, _zstd_dicts
+        if zstandard is None:
+            self.skipTest('zstandard is not installed')
+
+        calls = []
+        def f(value):
+            calls.append(value)
+            return {'value': value, 'pad': 'hello world ' * (value + 10)}
+
+        plain = cache(self.folder, create=True, memory=False)(f)
+        values = list(range(200))
+        for v in values:
+            plain(v)
+
+        zdict = train_zstd_dictionary(self.folder, dict_size=4096)
+        zs = cache(self.folder, memory=False, compress='zstd')(f)
+        for v in values:
+            zs(v, _refresh_cache=True)
+
+        self.worker.mkdir()
+        shutil.copy(build_pack(self.folder), self.worker)
+        _zstd_dicts.pop(zdict.dict_id())  # as if on another machine
+        cold = cache(self.worker, memory=False)(f)
+        calls.clear()
+        for v in values:
+            assert cold(v)['value'] == v
+
+        assert calls == [], calls
+
+
+class TestCacheVersion(TempFolderTestCase):
+    def test_version(self):
+        import os
+        from idlib.cache import cache, gc_versions, fingerprint
+        calls = []
+        def f(value):
+            calls.append(value)
+            return {'value': value}
+
+        v1, v2 = fingerprint('a, b'), fingerprint('a, b, c')
+        legacy = cache(self.folder, create=True, memory=False, return_path=True)(f)
+        _, path = legacy(1)
+        assert path.parent == self.folder
+
+        # root_version maps the existing unversioned entries to v1
+        f1 = cache(self.folder, memory=False, version=v1, root_version=v1)(f)
+        f1(1)
+        assert calls == [1], calls
+
+        f2 = cache(self.folder, memory=False, return_path=True,
+                   version=v2, root_version=v1)(f)
+        _, path = f2(1)
+        assert calls == [1, 1], calls
+        assert path.parent.name == 'v-' + v2
+
+        assert not gc_versions(self.folder, v2, root_version=v1, grace=60)
+        os.utime(self.folder / ('v-' + v2), (0, 0))
+        removed = gc_versions(self.folder, v1, root_version=v1, grace=60)
+        assert removed == [self.folder / ('v-' + v2)], removed
+        assert f1(1) == {'value': 1}
+        assert calls == [1, 1], calls
+
+
+class TestBlobStore(TempFolderTestCase):
+    def test_blobs(self):
+        from idlib.cache import BlobStore
+        blobs = BlobStore(self.tmp)
+        digest, size = blobs.put_chunks([b'hello ', b'world'])
+        assert size == 11 and digest in blobs
+        assert blobs.put_chunks([b'hello world'])[0] == digest  # stored once
+        view = blobs.open(digest)
+        assert view[:5] == b'hello' and view.read() == b'hello world'
+        assert blobs.open(blobs.put_chunks([])[0]) == b''
+
+        def failing():
+            yield b'partial'
+            raise ValueError('stop')
+
+        try:
+            blobs.put_chunks(failing())
+            assert False, 'should have raised'
+        except ValueError:
+            pass
+
+        assert not list(self.tmp.glob('.blob.*'))
+
+
+class TestCanonicalKeys(TempFolderTestCase):
+    def test_doi_case(self):
+        import idlib
+        from idlib.cache import cache, rekey
+        calls = []
+
+        @cache(self.folder, create=True, memory=False)
+        def f(identifier):
+            calls.append(identifier)
+            return {'id': str(identifier)}
+
+        dois = [idlib.Doi(d).identifier for d in
+                ('10.1000/ABC', 'doi:10.1000/abc', 'https://doi.org/10.1000/Abc')]
+        for d in dois:
+            f(d)
+
+        assert len(calls) == 1, calls
+
+        # simulate entries written before canonical keys
+        legacy = f.cache_store
+        for d in dois[1:]:
+            legacy.put(f.cache_key(d, _canonical=False), b'{"id": "legacy"}')
+
+        moved, removed = rekey(f, [(d,) for d in dois])
+        assert (moved, removed) == (0, 1), (moved, removed)
+        assert sorted(legacy.keys()) == [f.cache_key(dois[0])]
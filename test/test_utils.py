@@ -1,3 +1,4 @@
+from contextlib import contextmanager
 from time import sleep
 from idlib.utils import timeout
 
@@ -10,3 +11,713 @@ def test_timeout():
     asdf = timeout(1)(slps)
     out = asdf(2)
     assert out is None, 'oops'
+
+
+def test_lru_bounds():
+    from idlib.utils import LRUCache
+    lru = LRUCache(max_entries=2, max_bytes=10)
+    lru.put('a', 1, 4)
+    lru.put('b', 2, 4)
+    assert lru.get('a') == 1  # a is now most recent
+    lru.put('c', 3, 4)  # evicts b on bytes
+    assert 'b' not in lru and 'a' in lru and 'c' in lru
+    lru.put('d', 4, 100)  # too big to keep
+    assert 'd' not in lru
+    assert lru.nbytes == 8
+    assert lru.stats()['hits'] == 1
+
+
+def test_resp_json():
+    import requests
+    from idlib.utils import resp_json
+    resp = requests.models.Response()
+    resp._content = b'{"a": [1, 2]}'
+    resp.encoding = 'utf-8'
+    assert resp_json(resp) == {'a': [1, 2]}
+
+
+BIG = bytes(range(256)) * 1024
+
+
+@contextmanager
+def _chain_cache(folder, **kwargs):
+    """ keep resolution chains under folder instead of cache-path """
+    from idlib.cache import cache
+    from idlib.streams import Stream, StreamUri
+    old = Stream.__dict__['_dereference_chain_records']
+    Stream._dereference_chain_records = cache(folder, create=True, **kwargs)(
+        old.__wrapped__)
+    try:
+        yield
+    finally:
+        Stream._dereference_chain_records = old
+        StreamUri._dereference_cache.clear()
+
+
+def _local_server(ports=None):
+    import threading
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        def do_HEAD(self):
+            if ports is not None:
+                ports.append(self.client_address[1])
+
+            if self.path == '/redirect':
+                self.send_response(301)
+                self.send_header('Location', '/')
+            elif self.path == '/missing':
+                self.send_response(404)
+            elif self.path.startswith('/loop/'):
+                n = int(self.path.rsplit('/', 1)[-1])
+                self.send_response(302)
+                self.send_header('Location', f'/loop/{(n + 1) % 3}')
+            elif self.path.startswith('/hops/'):
+                n = int(self.path.rsplit('/', 1)[-1])
+                self.send_response(302)
+                self.send_header('Location', f'/hops/{n + 1}')
+            elif self.path == '/flaky' and getattr(server, 'flaky', 0):
+                server.flaky -= 1
+                self.send_response(503)
+            elif self.path == '/big':
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', str(len(BIG)))
+                self.end_headers()
+                return
+            elif self.path in ('/slow', '/slower'):
+                import time
+                time.sleep(1 if self.path == '/slow' else 2)
+                self.send_response(200)
+            elif self.path.startswith('/nohead') and self.command == 'HEAD':
+                self.send_response(400)
+            elif self.path.startswith('/nohead/loop/'):
+                n = int(self.path.rsplit('/', 1)[-1])
+                self.send_response(302)
+                self.send_header('Location', f'/nohead/loop/{(n + 1) % 3}')
+            elif self.path.startswith('/nohead/hops/'):
+                n = int(self.path.rsplit('/', 1)[-1])
+                self.send_response(302)
+                self.send_header('Location', f'/nohead/hops/{n + 1}')
+            elif self.path == '/nohead/ua' and 'Mozilla' not in self.headers.get(
+                    'User-Agent', ''):
+                self.send_response(403)
+            elif self.path == '/later':
+                self.send_response(429)
+                self.send_header('Retry-After', '60')
+            elif self.path == '/limited' and not getattr(server, 'limited', False):
+                server.limited = True
+                self.send_response(429)
+                self.send_header('Retry-After', '1')
+            else:
+                self.send_response(200)
+
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+
+        def do_GET(self):
+            self.do_HEAD()
+            self.wfile.write(BIG if self.path == '/big' else b'ok')
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def test_pooled_requests():
+    from idlib.core import PooledRequests
+    ports = []
+    server = _local_server(ports)
+    try:
+        requests = PooledRequests()
+        url = f'http://127.0.0.1:{server.server_port}/'
+        assert [requests.get(url).text for _ in range(3)] == ['ok'] * 3
+        assert len(set(ports)) == 1, ports  # one connection kept alive
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_resolve_many():
+    import threading
+    from idlib import resolve_many
+    lock = threading.Lock()
+    running, peak = [0], [0]
+
+    class Fake:
+        def __init__(self, identifier):
+            if identifier == 'bad':
+                raise ValueError(identifier)
+
+            self.identifier = identifier
+
+        def metadata(self):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+
+            sleep(0.01 * (self.identifier % 3))
+            with lock:
+                running[0] -= 1
+
+            if self.identifier == 7:
+                raise KeyError(self.identifier)
+
+            return {'id': self.identifier}
+
+    ids = list(range(20)) + ['bad']
+    results = list(resolve_many(ids, stream=Fake, per_system=4))
+    assert [r.index for r in results] == list(range(21))
+    assert results[3].values == {'metadata': {'id': 3}}
+    assert isinstance(results[7].error, KeyError)
+    assert isinstance(results[20].error, ValueError)
+    assert peak[0] <= 4, peak
+
+    unordered = list(resolve_many(range(10), stream=Fake, ordered=False))
+    assert sorted(r.index for r in unordered) == list(range(10))
+
+
+def test_aresolution_chain():
+    import asyncio
+    from idlib.core import resolution_chain_responses, aresolution_chain_responses
+    server = _local_server()
+    try:
+        base = f'http://127.0.0.1:{server.server_port}'
+        for path in ('/redirect', '/missing'):
+            sync = [None if r is None else r.url for r in resolution_chain_responses(
+                base + path, raise_on_final=False)]
+            chain = asyncio.run(aresolution_chain_responses(base + path, raise_on_final=False))
+            assert [None if r is None else r.url for r in chain] == sync, (chain, sync)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_rate_limiter():
+    import time
+    import pytest
+    from idlib import exceptions as exc
+    from idlib.core import PooledRequests, RateLimiter, TokenBucket
+    bucket = TokenBucket(rate=10, burst=2)
+    delays = [bucket.reserve() for _ in range(4)]
+    assert delays[:2] == [0, 0], delays
+    assert 0.05 < delays[2] <= 0.1 < delays[3] <= 0.2, delays
+    assert bucket.paused() == 0
+    bucket.pause(30)
+    assert 29 < bucket.paused() <= 30
+
+    server = _local_server()
+    try:
+        requests = PooledRequests(limiter=RateLimiter({}))
+        start = time.time()
+        resp = requests.get(f'http://127.0.0.1:{server.server_port}/limited')
+        assert resp.status_code == 200, resp
+        assert time.time() - start >= 0.9
+
+        # without a deadline a sync caller does not sleep past MAX_SYNC_WAIT
+        requests = PooledRequests(limiter=RateLimiter({}))
+        start = time.time()
+        resp = requests.get(f'http://127.0.0.1:{server.server_port}/later')
+        assert resp.status_code == 429, resp
+        with pytest.raises(exc.AccessLimitError):
+            requests.get(f'http://127.0.0.1:{server.server_port}/later')
+
+        assert time.time() - start < 5
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_chain_records():
+    import json
+    from idlib.core import resolution_chain_responses, chain_records, chain_from_records
+    server = _local_server()
+    try:
+        url = f'http://127.0.0.1:{server.server_port}/redirect'
+        chain = list(resolution_chain_responses(url, raise_on_final=False))
+        records = json.loads(json.dumps(chain_records(chain)))
+        rebuilt = chain_from_records(records)
+        assert [r.url for r in rebuilt] == [r.url for r in chain]
+        assert rebuilt[0].is_redirect and rebuilt[-1].ok
+        assert rebuilt[-1].headers['content-type'] == 'text/plain'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_dereference_cache():
+    import gc
+    from idlib.streams import StreamUri
+    from idlib.utils import StringProgenitor, LRUCache
+    old = StreamUri._dereference_cache, StreamUri._dereference_weak
+    StreamUri._dereference_cache = LRUCache(max_entries=2)
+    try:
+        for weak in (False, True):
+            StreamUri._dereference_weak = weak
+            StreamUri._dereference_cache.clear()
+            chains = [(StringProgenitor(f'a{i}', progenitor=object()), None)
+                      for i in range(3)]
+            for i, chain in enumerate(chains):
+                StreamUri._dereference_cache_put(i, chain)
+
+            assert len(StreamUri._dereference_cache) == 2
+            assert StreamUri._dereference_cache_get(0) is None
+            assert StreamUri._dereference_cache_get(2) == chains[2]
+
+        del chains, chain
+        gc.collect()
+        assert StreamUri._dereference_cache_get(2) is None
+        assert len(StreamUri._dereference_cache) == 1
+    finally:
+        StreamUri._dereference_cache, StreamUri._dereference_weak = old
+
+
+def test_host_capabilities():
+    import tempfile
+    from pathlib import Path
+    from idlib import core
+    from idlib.core import HostCapabilities, resolution_chain_responses
+    requests = []
+    server = _local_server(requests)
+    old = core.host_capabilities
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'host-capabilities.json'
+        core.host_capabilities = HostCapabilities(path)
+        try:
+            url = f'http://127.0.0.1:{server.server_port}/nohead/ua'
+            chain = list(resolution_chain_responses(url))
+            assert chain[-1].ok and len(requests) == 3, requests
+            assert core.host_capabilities.get(url) == {
+                HostCapabilities.HEAD_BROKEN, HostCapabilities.NEEDS_USER_AGENT}
+
+            # a fresh process reads the memo and goes straight to GET with the UA
+            core.host_capabilities = HostCapabilities(path)
+            requests.clear()
+            chain = list(resolution_chain_responses(url))
+            assert chain[-1].ok and len(requests) == 1, requests
+
+            # processes that learn about different hosts do not drop each other's
+            other = HostCapabilities(path)
+            other.get(url)  # read before the next learn
+            core.host_capabilities.learn('http://a.example.org', HostCapabilities.HEAD_BROKEN)
+            other.learn('http://b.example.org', HostCapabilities.HEAD_BROKEN)
+            fresh = HostCapabilities(path)
+            assert fresh.get('http://a.example.org') and fresh.get('http://b.example.org')
+            assert fresh.get(url) == {
+                HostCapabilities.HEAD_BROKEN, HostCapabilities.NEEDS_USER_AGENT}
+
+            # a HEAD that hits a 5xx says nothing about the host
+            core.host_capabilities = HostCapabilities(Path(tmp) / 'flaky.json')
+            server.flaky = 1
+            url = f'http://127.0.0.1:{server.server_port}/flaky'
+            chain = list(resolution_chain_responses(url))
+            assert chain[-1].ok and core.host_capabilities.get(url) == set()
+        finally:
+            core.host_capabilities = old
+            server.shutdown()
+            server.server_close()
+
+
+def test_resolution_bounds():
+    import pytest
+    from idlib import exceptions as exc
+    from idlib.core import resolution_chain_responses
+    server = _local_server()
+    base = f'http://127.0.0.1:{server.server_port}'
+    try:
+        with pytest.raises(exc.RedirectLoopError) as info:
+            list(resolution_chain_responses(base + '/loop/0'))
+
+        assert [r.url for r in info.value.chain][::2] == [
+            base + '/loop/0', base + '/loop/1', base + '/loop/2']
+
+        with pytest.raises(exc.TooManyRedirectsError) as info:
+            list(resolution_chain_responses(base + '/hops/0', max_hops=3))
+
+        assert len(info.value.chain) == 7
+
+        with pytest.raises(exc.ResolutionTimeoutError):
+            list(resolution_chain_responses(base + '/slow', timeout=0.2))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_resolution_bounds_head_broken():
+    # the GET fallbacks must not follow redirects behind the bounds
+    import asyncio
+    import tempfile
+    from pathlib import Path
+    import pytest
+    from idlib import core
+    from idlib import exceptions as exc
+    from idlib.core import (HostCapabilities, resolution_chain_responses,
+                            aresolution_chain_responses)
+    server = _local_server()
+    base = f'http://127.0.0.1:{server.server_port}'
+    old = core.host_capabilities
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            for memo in ('fresh', 'known'):  # try_get then known_get
+                core.host_capabilities = HostCapabilities(Path(tmp) / f'{memo}.json')
+                if memo == 'known':
+                    core.host_capabilities.learn(base, HostCapabilities.HEAD_BROKEN)
+
+                with pytest.raises(exc.RedirectLoopError) as info:
+                    list(resolution_chain_responses(base + '/nohead/loop/0'))
+
+                assert [r.url for r in info.value.chain][::2] == [
+                    base + '/nohead/loop/0', base + '/nohead/loop/1',
+                    base + '/nohead/loop/2']
+
+                with pytest.raises(exc.TooManyRedirectsError) as info:
+                    list(resolution_chain_responses(base + '/nohead/hops/0', max_hops=3))
+
+                assert len(info.value.chain) == 7
+
+                with pytest.raises(exc.RedirectLoopError):
+                    asyncio.run(aresolution_chain_responses(base + '/nohead/loop/0'))
+
+                with pytest.raises(exc.TooManyRedirectsError) as info:
+                    asyncio.run(aresolution_chain_responses(base + '/nohead/hops/0',
+                                                            max_hops=3))
+
+                assert len(info.value.chain) == 7
+        finally:
+            core.host_capabilities = old
+            server.shutdown()
+            server.server_close()
+
+
+def test_record_replay():
+    import tempfile
+    from pathlib import Path
+    from time import perf_counter
+    from idlib import exceptions as exc
+    from idlib.core import PooledRequests, resolution_chain_responses
+    from idlib.replay import record, replay
+    server = _local_server()
+    url = f'http://127.0.0.1:{server.server_port}/redirect'
+    with tempfile.TemporaryDirectory() as tmp:
+        corpus = Path(tmp) / 'corpus.jsonl.gz'
+        try:
+            with record(corpus):
+                live = [None if r is None else (r.url, getattr(r, 'status_code', None))
+                        for r in resolution_chain_responses(url)]
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        with replay(corpus, latency=0.05):
+            start = perf_counter()
+            replayed = [None if r is None else (r.url, getattr(r, 'status_code', None))
+                        for r in resolution_chain_responses(url)]
+            assert perf_counter() - start >= 0.1
+
+        assert replayed == live, (replayed, live)
+        assert live[0][1] == 301 and live[-1][1] == 200
+
+        requests = PooledRequests()
+        with replay(corpus, requests=requests):
+            try:
+                requests.get(url + '/never')
+                assert False, 'should have failed'
+            except requests.exceptions.ConnectionError:
+                pass
+
+
+def test_mock_resolver():
+    from idlib.core import resolution_chain_responses, PooledRequests, RateLimiter
+    from idlib.mock import MockResolver
+    doi = 'https://doi.org/10.0000/mock'
+    routes = [
+        {'url': doi, 'status_code': 302,
+         'headers': {'Location': 'https://example.org/landing'}, 'text': ''},
+        {'url': 'https://example.org/landing', 'status_code': 200,
+         'headers': {'Content-Type': 'text/html'}, 'text': '<html></html>'},
+        {'url': 'https://api.example.org/works', 'status_code': 200,
+         'headers': {'Content-Type': 'application/json'}, 'json': {'ok': True}},]
+    with MockResolver(routes, rate_limits={'api.example.org': 1}) as server:
+        chain = list(resolution_chain_responses(doi))
+        assert [r.url for r in chain] == [doi, 'https://example.org/landing',
+                                          'https://example.org/landing']
+        assert chain[-1].status_code == 200
+
+        requests = PooledRequests(limiter=RateLimiter({}))
+        server.mount(requests)
+        assert requests.get('https://api.example.org/works').json() == {'ok': True}
+        # the second request in the same second is a 429 that gets retried
+        assert requests.get('https://api.example.org/works').ok
+        assert server.counts['api.example.org', 429] == 1
+        assert requests.get('https://nowhere.example.org/').status_code == 404
+
+    server = MockResolver(routes, error_rate=1, error_burst=2).start()
+    try:
+        requests = PooledRequests(limiter=RateLimiter({}))
+        server.mount(requests)
+        assert [requests.get(doi, allow_redirects=False).status_code
+                for _ in range(2)] == [503, 503]
+    finally:
+        server.unmount()
+        server.stop()
+
+
+def test_mock_resolver_stop():
+    import asyncio
+    import logging
+    from idlib.core import pooled_requests, apooled_requests
+    from idlib.mock import MockResolver
+    url = 'https://doi.org/10.0000/mock'
+    routes = [{'url': url, 'status_code': 200,
+               'headers': {'Content-Type': 'text/plain'}, 'text': 'ok'}]
+    errors = []
+    class Handler(logging.Handler):
+        def emit(self, record):
+            errors.append(record.getMessage())
+
+    handler = Handler(logging.ERROR)
+    logging.getLogger('asyncio').addHandler(handler)
+    try:
+        # stopping with keep-alive connections still open is quiet
+        with MockResolver(routes):
+            assert pooled_requests.get(url).ok
+
+            async def aget():
+                return await apooled_requests.get(url)
+
+            assert asyncio.run(aget()).ok
+    finally:
+        logging.getLogger('asyncio').removeHandler(handler)
+
+    assert not errors, errors
+
+
+def test_deadline():
+    import asyncio
+    import tempfile
+    import threading
+    from pathlib import Path
+    from time import perf_counter
+    import pytest
+    from idlib import exceptions as exc
+    from idlib.cache import key_lock, akey_lock, _try_acquire, _release
+    from idlib.core import PooledRequests, AsyncRequests
+    from idlib.utils import deadline, current_deadline, timeout
+    server = _local_server()
+    slow = f'http://127.0.0.1:{server.server_port}/slow'
+    slower = f'http://127.0.0.1:{server.server_port}/slower'
+    try:
+        requests = PooledRequests()
+        with deadline(5) as outer:
+            with deadline(60) as inner:
+                assert inner is outer  # nested deadlines only shorten
+
+            start = perf_counter()
+            with deadline(0.3):
+                with pytest.raises(exc.DeadlineExceededError):
+                    requests.get(slow)
+
+            assert perf_counter() - start < 0.9
+            assert current_deadline() is outer
+
+        async def aget():
+            with deadline(0.3):
+                return await AsyncRequests(requests).get(slow)
+
+        with pytest.raises(exc.DeadlineExceededError):
+            asyncio.run(aget())
+
+        # signals are main thread only, off it timeout uses a deadline
+        errors = []
+        @timeout(1, error=exc.CouldNotReachIndexError)
+        def get():
+            requests.get(slower)
+
+        def run():
+            try:
+                get()
+            except Exception as e:
+                errors.append(e)
+
+        start = perf_counter()
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        assert isinstance(errors[0], exc.CouldNotReachIndexError), errors
+        assert perf_counter() - start < 1.9
+
+        # waiting on a cache key lock that someone else holds
+        with tempfile.TemporaryDirectory() as tmp:
+            folder = Path(tmp)
+            (folder / '.locks').mkdir()
+            fd = _try_acquire(folder / '.locks' / 'key')
+            try:
+                start = perf_counter()
+                with deadline(0.3), pytest.raises(exc.DeadlineExceededError):
+                    with key_lock(folder, 'key'):
+                        pass
+
+                async def alock():
+                    with deadline(0.3):
+                        async with akey_lock(folder, 'key'):
+                            pass
+
+                with pytest.raises(exc.DeadlineExceededError):
+                    asyncio.run(alock())
+
+                assert perf_counter() - start < 2
+            finally:
+                _release(folder / '.locks' / 'key', fd)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_data_streaming():
+    import pytest
+    from idlib import exceptions as exc
+    from idlib.streams import StreamUri
+
+    class Local(StreamUri):
+        _id_class = str
+        def asUri(self):
+            return self._identifier
+
+    server = _local_server()
+    try:
+        s = Local(f'http://127.0.0.1:{server.server_port}/big')
+        chunks = list(s.data_chunks(chunk_size=4096))
+        assert len(chunks) > 1 and b''.join(chunks) == BIG
+        assert s.data() == BIG
+        with s.data_file() as f:
+            assert f.read() == BIG
+
+        with pytest.raises(exc.DataTooLargeError):
+            s.data(max_bytes=len(BIG) - 1)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_data_file_cache():
+    import hashlib
+    import tempfile
+    from pathlib import Path
+    from idlib.cache import cache, evict, namespaces, BlobStore
+    from idlib.streams import StreamUri
+
+    class Local(StreamUri):
+        _id_class = str
+        def asUri(self):
+            return self._identifier
+
+    requests = []
+    server = _local_server(requests)
+    old = StreamUri._data_blobs, StreamUri._data_blob
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        StreamUri._data_blobs = BlobStore(tmp / 'data')
+        StreamUri._data_blob = cache(tmp / 'data_index', create=True)(
+            old[1].__wrapped__)
+        try:
+            s = Local(f'http://127.0.0.1:{server.server_port}/big')
+            assert s.data_file(cache=True)[:] == BIG
+            fetched = len(requests)
+            assert s.data_file(cache=True)[:] == BIG
+            assert len(requests) == fetched  # served from the blob
+
+            # gc sees the blob like any other entry
+            digest = hashlib.sha256(BIG).hexdigest()
+            assert digest in {k for store in namespaces(tmp) for k in store.keys()}
+            assert evict(StreamUri._data_blobs, 0) == (1, len(BIG))
+            assert digest not in StreamUri._data_blobs
+
+            # and the index entry left behind is refreshed
+            assert s.data_file(cache=True)[:] == BIG
+            assert len(requests) > fetched and digest in StreamUri._data_blobs
+        finally:
+            StreamUri._data_blobs, StreamUri._data_blob = old
+            server.shutdown()
+            server.server_close()
+
+
+def test_data_borrowed():
+    import idlib
+    from idlib.mock import MockResolver
+    routes = [{'url': 'https://doi.org/10.1000/abc', 'status_code': 200,
+               'headers': {'Content-Type': 'text/plain'}, 'text': 'data'}]
+    with MockResolver(routes):
+        # Doi borrows data from StreamUri without inheriting from it
+        doi = idlib.Doi('10.1000/abc')
+        assert doi.data() == b'data'
+        assert list(doi.data_chunks()) == [b'data']
+        with doi.data_file() as f:
+            assert f.read() == b'data'
+
+
+def test_dereference_chain_borrowed():
+    import tempfile
+    from pathlib import Path
+    import idlib
+    from idlib.mock import MockResolver
+    doi = 'https://doi.org/10.1000/abc'
+    routes = [{'url': doi, 'status_code': 302,
+               'headers': {'Location': 'https://example.org/abc'}, 'text': ''},
+              {'url': 'https://example.org/abc', 'status_code': 200,
+               'headers': {'Content-Type': 'text/html'}, 'text': ''},]
+    with tempfile.TemporaryDirectory() as tmp, _chain_cache(Path(tmp)), MockResolver(routes):
+        # Doi borrows dereference_chain from StreamUri
+        assert idlib.Doi('10.1000/abc').dereference() == 'https://example.org/abc'
+
+
+def test_chain_cooldown():
+    import json
+    import tempfile
+    from pathlib import Path
+    import pytest
+    from idlib import exceptions as exc
+    from idlib.cache import cooldown_policy, COOLDOWN, memory
+    from idlib.streams import Stream, StreamUri
+
+    class Local(StreamUri):
+        _id_class = str
+        def asUri(self):
+            return self._identifier
+
+    requests = []
+    server = _local_server(requests)
+    server.flaky = 2  # HEAD and the GET from try_get
+    url = f'http://127.0.0.1:{server.server_port}/flaky'
+    policy = cooldown_policy({500: 0.5})
+    try:
+        with tempfile.TemporaryDirectory() as tmp, _chain_cache(Path(tmp), cooldown=policy):
+            with pytest.raises(exc.RemoteError):
+                Local(url).dereference()
+
+            store = Stream._dereference_chain_records.cache_store
+            blob = json.loads(store.get(Stream._dereference_chain_records.cache_key(
+                Local(url), url)))
+            assert COOLDOWN in blob and blob['http_status_code'] == 503
+
+            # a restarted process is in cooldown and does not ask again
+            memory.clear()
+            StreamUri._dereference_cache.clear()
+            count = len(requests)
+            with pytest.raises(exc.ExistenceUnknownError):
+                Local(url).dereference()
+
+            assert len(requests) == count
+
+            # and asks again once the cooldown for a 503 is over
+            sleep(0.6)
+            memory.clear()
+            assert Local(url).dereference() == url
+    finally:
+        server.shutdown()
+        server.server_close()